@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+'''
+Local stand-in for the ENCODE portal serving synthetic search, experiment
+and file JSON and file bodies, with configurable latency, bandwidth and
+error rate. Used by run_benchmarks.py; can also be run on its own.
+'''
+
+import time
+import json
+import random
+import hashlib
+import argparse
+import threading
+import collections
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+CHUNK_SIZE = 64*1024
+BODY_BLOCK = (b'ACGTN\n'*(CHUNK_SIZE//6+1))[:CHUNK_SIZE]
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(prog='Mock ENCODE portal',
+                        description='Serves synthetic ENCODE portal JSON and file bodies.')
+    add_mock_portal_arguments(parser)
+    parser.add_argument('--port', type=int, default=8000,
+                            help='Port to listen on.')
+    return parser.parse_args()
+
+def add_mock_portal_arguments(parser):
+    parser.add_argument('--num-experiments', type=int, default=20,
+                            help='Number of experiments returned by a search.')
+    parser.add_argument('--num-replicates', type=int, default=2,
+                            help='Number of biological replicates per experiment. \
+                            Each replicate has paired-end fastqs and a bam.')
+    parser.add_argument('--file-size', type=int, default=1024*1024,
+                            help='Size of each file body in bytes.')
+    parser.add_argument('--latency', type=float, default=0.0,
+                            help='Delay in seconds before each response.')
+    parser.add_argument('--bandwidth', type=float, default=0.0,
+                            help='Bandwidth limit per connection in bytes/sec (0 for unlimited).')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                            help='Fraction of requests answered with HTTP 503.')
+    parser.add_argument('--seed', type=int, default=0,
+                            help='Random seed for error injection.')
+
+def body_slice(start, end):
+    # file body is BODY_BLOCK repeated
+    offset = start % CHUNK_SIZE
+    return (BODY_BLOCK+BODY_BLOCK)[offset:offset+end-start]
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class MockPortal(object):
+    '''
+    Experiments ENCSR[0-9]{7}E each have one control ENCSR[0-9]{7}C.
+    File accessions are ENCFF[0-9]{7} + [A-Z] (one letter per file in a dataset).
+    '''
+    def __init__(self, num_experiments=20, num_replicates=2, file_size=1024*1024,
+                latency=0.0, bandwidth=0.0, error_rate=0.0, seed=0,
+                host='127.0.0.1', port=0):
+        self.num_experiments = num_experiments
+        self.num_replicates = num_replicates
+        self.file_size = file_size
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+        self.md5sum = self.get_body_md5sum(file_size)
+        self.server = ThreadingHTTPServer((host, port), self.get_handler_class())
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return 'http://{}:{}'.format(*self.server.server_address[:2])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats.clear()
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    def is_error(self):
+        if not self.error_rate: return False
+        with self.lock:
+            return self.random.random()<self.error_rate
+
+    @staticmethod
+    def get_body_md5sum(file_size):
+        md5 = hashlib.md5()
+        for start in range(0, file_size, CHUNK_SIZE):
+            md5.update(body_slice(start, min(file_size, start+CHUNK_SIZE)))
+        return md5.hexdigest()
+
+    def get_exp_accession_ids(self):
+        return ['ENCSR{:07d}E'.format(i) for i in range(self.num_experiments)]
+
+    def get_num_replicates(self, accession_id):
+        # controls have one replicate
+        return 1 if accession_id.endswith('C') else self.num_replicates
+
+    def is_valid_accession_id(self, accession_id):
+        return len(accession_id)==13 and accession_id[5:12].isdigit() and \
+            int(accession_id[5:12])<self.num_experiments and accession_id[12] in 'EC'
+
+    def get_files(self, accession_id):
+        # fastq R1/R2 and a bam for each replicate
+        num = int(accession_id[5:12])*2 + (1 if accession_id.endswith('C') else 0)
+        files = []
+        letters = iter('ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+        for rep in range(1, self.get_num_replicates(accession_id)+1):
+            fastqs = [next(letters), next(letters)]
+            for pair in (1, 2):
+                file_acc_id = 'ENCFF{:07d}{}'.format(num, fastqs[pair-1])
+                files.append(self.make_file(accession_id, file_acc_id, 'fastq', 'reads',
+                    rep, dict(paired_end=str(pair), run_type='paired-ended',
+                    paired_with='/files/ENCFF{:07d}{}/'.format(num, fastqs[2-pair]))))
+            file_acc_id = 'ENCFF{:07d}{}'.format(num, next(letters))
+            files.append(self.make_file(accession_id, file_acc_id, 'bam', 'unfiltered alignments',
+                rep, dict(assembly='GRCh38')))
+        return files
+
+    def get_file(self, file_acc_id):
+        if len(file_acc_id)!=13 or not file_acc_id[5:12].isdigit():
+            return None
+        num = int(file_acc_id[5:12])
+        dataset = 'ENCSR{:07d}{}'.format(num//2, 'C' if num%2 else 'E')
+        if not self.is_valid_accession_id(dataset):
+            return None
+        for f in self.get_files(dataset):
+            if f['accession']==file_acc_id:
+                return f
+        return None
+
+    def make_file(self, accession_id, file_acc_id, file_type, output_type, rep, extra):
+        ext = 'fastq.gz' if file_type=='fastq' else file_type
+        f = {
+            '@id': '/files/{}/'.format(file_acc_id),
+            'accession': file_acc_id,
+            'dataset': '/experiments/{}/'.format(accession_id),
+            'status': 'released',
+            'file_type': file_type,
+            'file_format': file_type,
+            'output_type': output_type,
+            'href': '/files/{0}/@@download/{0}.{1}'.format(file_acc_id, ext),
+            'md5sum': self.md5sum,
+            'file_size': self.file_size,
+            'biological_replicates': [rep],
+            'technical_replicates': ['{}_1'.format(rep)],
+        }
+        f.update(extra)
+        return f
+
+    def get_experiment(self, accession_id):
+        files = self.get_files(accession_id)
+        exp = {
+            '@id': '/experiments/{}/'.format(accession_id),
+            'accession': accession_id,
+            'status': 'released',
+            'assay_term_name': 'ChIP-seq',
+            'assembly': ['GRCh38'],
+            'replicates': [{'biological_replicate_number': i+1,
+                'library': {'biosample': {'organism': {'scientific_name': 'Homo sapiens'}}}}
+                for i in range(self.get_num_replicates(accession_id))],
+            'original_files': [f['@id'] for f in files],
+            'files': files,
+            'possible_controls': [],
+            'contributing_files': [],
+        }
+        if accession_id.endswith('E'):
+            ctl_acc_id = accession_id[:-1]+'C'
+            exp['possible_controls'] = [{'@id': '/experiments/{}/'.format(ctl_acc_id)}]
+            exp['contributing_files'] = [f['@id'] for f in self.get_files(ctl_acc_id)
+                if f['file_type']=='fastq']
+        return exp
+
+    def search_files(self, query):
+        dataset = query.get('dataset', [''])[0].strip('/').split('/')[-1]
+        if not self.is_valid_accession_id(dataset):
+            return []
+        files = self.get_files(dataset)
+        for key in ('status', 'file_format', 'output_type', 'assembly'):
+            if key in query:
+                files = [f for f in files if f.get(key) in query[key]]
+        return files
+
+    def get_handler_class(self):
+        portal = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_HEAD(self):
+                self.handle_request(head=True)
+
+            def do_GET(self):
+                self.handle_request(head=False)
+
+            def handle_request(self, head):
+                if portal.latency: time.sleep(portal.latency)
+                url = urlparse(self.path)
+                path = url.path.strip('/').split('/')
+                query = parse_qs(url.query)
+                if path[0]=='files' and len(path)>2 and path[2]=='@@download':
+                    request_type = 'download'
+                elif path[0] in ('search', 'experiments', 'files'):
+                    request_type = path[0]
+                else:
+                    return self.send_json(404, {'status': 'error', 'title': 'Not Found'}, head)
+                portal.count('requests_'+request_type)
+                if portal.is_error():
+                    portal.count('errors_'+request_type)
+                    return self.send_json(503, {'status': 'error', 'title': 'Service Unavailable'}, head)
+
+                if request_type=='search':
+                    if query.get('type', [''])[0]=='File':
+                        graph = portal.search_files(query)
+                    else:
+                        graph = [{'@id': '/experiments/{}/'.format(a), 'accession': a}
+                            for a in portal.get_exp_accession_ids()]
+                    return self.send_json(200, {'@graph': graph, 'total': len(graph)}, head)
+                accession_id = path[1] if len(path)>1 else ''
+                if request_type=='experiments':
+                    if not portal.is_valid_accession_id(accession_id):
+                        return self.send_json(404, {'status': 'error', 'title': 'Not Found'}, head)
+                    return self.send_json(200, portal.get_experiment(accession_id), head)
+                f = portal.get_file(accession_id)
+                if f is None:
+                    return self.send_json(404, {'status': 'error', 'title': 'Not Found'}, head)
+                if request_type=='files':
+                    return self.send_json(200, f, head)
+                return self.send_body(head)
+
+            def send_json(self, code, obj, head):
+                body = json.dumps(obj).encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if not head:
+                    self.wfile.write(body)
+                    portal.count('bytes_json', len(body))
+
+            def send_body(self, head):
+                start = 0
+                end = portal.file_size
+                rng = self.headers.get('Range')
+                if rng and rng.startswith('bytes='):
+                    first, _, last = rng[6:].partition('-')
+                    start = int(first or 0)
+                    if last: end = min(end, int(last)+1)
+                if start>=portal.file_size and portal.file_size:
+                    self.send_response(416)
+                    self.send_header('Content-Range', 'bytes */{}'.format(portal.file_size))
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(206 if rng else 200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(end-start))
+                self.send_header('Accept-Ranges', 'bytes')
+                self.send_header('Last-Modified', 'Mon, 01 Jan 2018 00:00:00 GMT')
+                if rng:
+                    self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                        start, end-1, portal.file_size))
+                self.end_headers()
+                if head: return
+                t0 = time.time()
+                sent = 0
+                for pos in range(start, end, CHUNK_SIZE):
+                    chunk = body_slice(pos, min(end, pos+CHUNK_SIZE))
+                    try:
+                        self.wfile.write(chunk)
+                    except (IOError, OSError): # client killed
+                        break
+                    sent += len(chunk)
+                    portal.count('bytes_download', len(chunk))
+                    if portal.bandwidth:
+                        delay = sent/portal.bandwidth - (time.time()-t0)
+                        if delay>0: time.sleep(delay)
+
+        return Handler
+
+def main():
+    args = parse_arguments()
+    portal = MockPortal(num_experiments=args.num_experiments,
+        num_replicates=args.num_replicates,
+        file_size=args.file_size,
+        latency=args.latency,
+        bandwidth=args.bandwidth,
+        error_rate=args.error_rate,
+        seed=args.seed,
+        port=args.port)
+    print('Mock ENCODE portal: {}'.format(portal.base_url))
+    print('e.g. python encode_downloader.py "{}/search/?type=Experiment" --encode-base-url {}'.format(
+        portal.base_url, portal.base_url))
+    try:
+        portal.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(portal.get_stats()))
+
+if __name__=='__main__':
+    main()
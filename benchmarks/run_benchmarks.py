@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+'''
+Benchmarks encode_downloader.py, get_ctl_from_exp.py and
+generate_pipeline_run_sh.py against a local mock ENCODE portal.
+Each run appends one JSON line per scenario to a results file.
+Runs can be compared with a baseline results file to catch regressions.
+'''
+
+import os
+import sys
+import time
+import json
+import signal
+import shutil
+import argparse
+import datetime
+import tempfile
+import subprocess
+from mock_portal import MockPortal, add_mock_portal_arguments
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ['metadata', 'metadata_filter_on_portal', 'download', 'resume', 'ctl', 'scriptgen']
+# portal settings that make two results comparable
+PARAM_KEYS = ['num_experiments', 'num_replicates', 'file_size', 'latency',
+    'bandwidth', 'error_rate', 'max_download']
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(prog='ENCODE downloader benchmarks',
+                        description='Runs benchmark scenarios against a local mock ENCODE portal.')
+    parser.add_argument('--scenarios', nargs='+', default=SCENARIOS, choices=SCENARIOS,
+                            help='Scenarios to run.')
+    add_mock_portal_arguments(parser)
+    parser.add_argument('--max-download', type=int, default=8,
+                            help='--max-download for encode_downloader.py.')
+    parser.add_argument('--crash-at', type=float, default=0.5,
+                            help='Kill the downloader when this fraction of bytes is transferred (resume scenario).')
+    parser.add_argument('--repeat', type=int, default=1,
+                            help='Number of runs per scenario.')
+    parser.add_argument('--label', type=str, default='',
+                            help='Label stored with results.')
+    parser.add_argument('--out', type=str, default='bench_results.jsonl',
+                            help='Results are appended to this JSON lines file.')
+    parser.add_argument('--baseline', type=str,
+                            help='Results file to compare with. \
+                            Exits with 1 if any scenario is slower than baseline by --tolerance.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Allowed slowdown over baseline (0.2 for 20%%).')
+    parser.add_argument('--keep-work-dir', action='store_true',
+                            help='Do not remove temporary work directories.')
+    args = parser.parse_args()
+
+    if args.repeat<1:
+        raise Exception('--repeat must be >0.')
+    return args
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=REPO_DIR, stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_script(script, params, log_file, wait=True):
+    cmd = [sys.executable, os.path.join(REPO_DIR, script)] + params
+    with open(log_file, 'a') as fp:
+        # own process group so that wget/curl children can be killed together
+        p = subprocess.Popen(cmd, stdout=fp, stderr=subprocess.STDOUT,
+            preexec_fn=os.setsid)
+    if not wait:
+        return p
+    if p.wait():
+        raise Exception('Failed ({}): {}. See {}'.format(p.returncode, ' '.join(cmd), log_file))
+    return p
+
+def timed(func, *args):
+    t0 = time.time()
+    func(*args)
+    return time.time()-t0
+
+def get_search_url(portal):
+    return portal.base_url+'/search/?type=Experiment'
+
+def get_downloader_params(args, portal, work_dir, extra=[]):
+    return [get_search_url(portal), '--dir', work_dir,
+        '--file-types', 'fastq', 'bam:unfiltered alignments',
+        '--max-download', str(args.max_download),
+        '--encode-base-url', portal.base_url] + extra
+
+def get_num_files(args):
+    # fastq pair and unfiltered bam per replicate (see get_downloader_params)
+    return args.num_experiments*args.num_replicates*3
+
+def count_data_files(data_dir):
+    cnt = 0
+    for root, dirs, names in os.walk(data_dir):
+        cnt += len([n for n in names if n.startswith('ENCFF')])
+    return cnt
+
+def count_planned_files(log_file):
+    with open(log_file) as fp:
+        return sum(1 for line in fp if line.startswith('Dry-run ('))
+
+def get_num_requests(stats):
+    return sum(stats[k] for k in stats if k.startswith('requests_'))
+
+def bench_metadata(args, portal, work_dir, extra=[]):
+    log = os.path.join(work_dir, 'log.txt')
+    wall_time = timed(run_script, 'encode_downloader.py',
+        get_downloader_params(args, portal, os.path.join(work_dir, 'data'), ['--dry-run']+extra), log)
+    stats = portal.get_stats()
+    return wall_time, dict(
+        requests=get_num_requests(stats),
+        experiments_per_sec=args.num_experiments/wall_time,
+        dropped_files=get_num_files(args)-count_planned_files(log))
+
+def bench_metadata_filter_on_portal(args, portal, work_dir):
+    return bench_metadata(args, portal, work_dir, ['--filter-on-portal'])
+
+def bench_download(args, portal, work_dir):
+    log = os.path.join(work_dir, 'log.txt')
+    wall_time = timed(run_script, 'encode_downloader.py',
+        get_downloader_params(args, portal, os.path.join(work_dir, 'data')), log)
+    stats = portal.get_stats()
+    return wall_time, dict(
+        requests=get_num_requests(stats),
+        bytes=stats.get('bytes_download', 0),
+        bytes_per_sec=stats.get('bytes_download', 0)/wall_time,
+        errors=sum(stats[k] for k in stats if k.startswith('errors_')),
+        dropped_files=get_num_files(args)-count_data_files(os.path.join(work_dir, 'data')))
+
+def bench_resume(args, portal, work_dir):
+    log = os.path.join(work_dir, 'log.txt')
+    data_dir = os.path.join(work_dir, 'data')
+    total_bytes = get_num_files(args)*args.file_size
+    # crash
+    p = run_script('encode_downloader.py', get_downloader_params(args, portal, data_dir), log, wait=False)
+    while p.poll() is None and portal.get_stats().get('bytes_download', 0) < total_bytes*args.crash_at:
+        time.sleep(0.01)
+    if p.poll() is None:
+        os.killpg(os.getpgid(p.pid), signal.SIGKILL)
+    p.wait()
+    bytes_before_crash = portal.get_stats().get('bytes_download', 0)
+    portal.reset_stats()
+    # resume
+    wall_time = timed(run_script, 'encode_downloader.py',
+        get_downloader_params(args, portal, data_dir), log)
+    stats = portal.get_stats()
+    run_script('verify_downloads.py', ['--dir', data_dir, '--offline', '--nth', '2'], log)
+    cnt = {}
+    with open(os.path.join(data_dir, 'verify_report.tsv')) as fp:
+        next(fp)
+        for line in fp:
+            status = line.split('\t')[2]
+            cnt[status] = cnt.get(status, 0)+1
+    return wall_time, dict(
+        bytes_before_crash=bytes_before_crash,
+        bytes_resumed=stats.get('bytes_download', 0),
+        verify=cnt,
+        dropped_files=get_num_files(args)-count_data_files(data_dir))
+
+def write_exp_acc_ids(portal, work_dir):
+    exp_acc_ids = portal.get_exp_accession_ids()
+    exp_acc_ids_file = os.path.join(work_dir, 'exp_acc_ids.txt')
+    with open(exp_acc_ids_file, 'w') as fp:
+        fp.write('\n'.join(exp_acc_ids)+'\n')
+    return exp_acc_ids_file
+
+def bench_ctl(args, portal, work_dir):
+    log = os.path.join(work_dir, 'log.txt')
+    exp_acc_ids_file = write_exp_acc_ids(portal, work_dir)
+    wall_time = timed(run_script, 'get_ctl_from_exp.py',
+        ['--exp-acc-ids-file', exp_acc_ids_file,
+         '--out-filename-exp-to-ctl', os.path.join(work_dir, 'exp_to_ctl.txt'),
+         '--out-filename-ctl', os.path.join(work_dir, 'ctl_ids.txt'),
+         '--encode-base-url', portal.base_url], log)
+    return wall_time, dict(
+        experiments_per_sec=args.num_experiments/wall_time)
+
+def bench_scriptgen(args, portal, work_dir):
+    log = os.path.join(work_dir, 'log.txt')
+    exp_dir = os.path.join(work_dir, 'exp')
+    ctl_dir = os.path.join(work_dir, 'ctl')
+    exp_acc_ids_file = write_exp_acc_ids(portal, work_dir)
+    exp_to_ctl_file = os.path.join(work_dir, 'exp_to_ctl.txt')
+    ctl_acc_ids_file = os.path.join(work_dir, 'ctl_ids.txt')
+    # download tiny files to get metadata (not timed)
+    prep = MockPortal(num_experiments=args.num_experiments,
+        num_replicates=args.num_replicates, file_size=1).start()
+    try:
+        run_script('get_ctl_from_exp.py',
+            ['--exp-acc-ids-file', exp_acc_ids_file,
+             '--out-filename-exp-to-ctl', exp_to_ctl_file,
+             '--out-filename-ctl', ctl_acc_ids_file,
+             '--encode-base-url', prep.base_url], log)
+        run_script('encode_downloader.py', [exp_acc_ids_file, '--dir', exp_dir,
+            '--encode-base-url', prep.base_url], log)
+        run_script('encode_downloader.py', [ctl_acc_ids_file, '--dir', ctl_dir,
+            '--encode-base-url', prep.base_url], log)
+    finally:
+        prep.stop()
+    wall_time = timed(run_script, 'generate_pipeline_run_sh.py',
+        ['--exp-acc-ids-file', exp_acc_ids_file,
+         '--exp-data-root-dir', exp_dir,
+         '--ctl-data-root-dir', ctl_dir,
+         '--exp-id-to-ctl-id-file', exp_to_ctl_file,
+         '--exp-file-type', 'fastq',
+         '--pipeline-bds-script', 'chipseq.bds',
+         '--pipeline-cluster-engine', 'slurm',
+         '--pipeline-out-root-dir', os.path.join(work_dir, 'pipeline')], log)
+    return wall_time, dict(
+        samples_per_sec=args.num_experiments/wall_time)
+
+def run_scenario(args, scenario):
+    portal = MockPortal(num_experiments=args.num_experiments,
+        num_replicates=args.num_replicates,
+        file_size=args.file_size,
+        latency=args.latency,
+        bandwidth=args.bandwidth,
+        error_rate=args.error_rate,
+        seed=args.seed).start()
+    work_dir = tempfile.mkdtemp(prefix='encode_bench_{}_'.format(scenario))
+    try:
+        wall_time, metrics = globals()['bench_'+scenario](args, portal, work_dir)
+    finally:
+        portal.stop()
+        if not args.keep_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return wall_time, metrics
+
+def read_results(results_file):
+    results = []
+    with open(results_file, 'r') as fp:
+        for line in fp:
+            if line.strip():
+                results.append(json.loads(line))
+    return results
+
+def find_baseline(baseline, result):
+    # latest baseline result of the same scenario with the same params
+    for b in reversed(baseline):
+        if b['scenario']==result['scenario'] and b['params']==result['params']:
+            return b
+    return None
+
+def main():
+    args = parse_arguments()
+    baseline = read_results(args.baseline) if args.baseline else []
+    params = dict((k, getattr(args, k)) for k in PARAM_KEYS)
+    git_commit = get_git_commit()
+
+    regressions = []
+    # files missing from a plan or a download tree (e.g. portal errors taken as metadata)
+    dropped = []
+    for scenario in args.scenarios:
+        for i in range(args.repeat):
+            wall_time, metrics = run_scenario(args, scenario)
+            result = dict(
+                time=datetime.datetime.now().isoformat(),
+                label=args.label,
+                git_commit=git_commit,
+                scenario=scenario,
+                params=params,
+                wall_time=wall_time,
+                metrics=metrics)
+            with open(args.out, 'a') as fp:
+                fp.write(json.dumps(result, sort_keys=True)+'\n')
+            msg = '{}: {:.3f} sec {}'.format(scenario, wall_time, json.dumps(metrics, sort_keys=True))
+            b = find_baseline(baseline, result)
+            if b:
+                ratio = wall_time/b['wall_time'] if b['wall_time'] else float('inf')
+                msg += ' (x{:.2f} of baseline {})'.format(ratio, b['git_commit'])
+                if ratio>1.0+args.tolerance:
+                    msg += ' REGRESSION'
+                    regressions.append(scenario)
+            if metrics.get('dropped_files'):
+                msg += ' DROPPED FILES'
+                dropped.append(scenario)
+            print(msg)
+
+    if regressions:
+        print('Regressions: {}'.format(', '.join(sorted(set(regressions)))))
+    if dropped:
+        print('Dropped files: {}'.format(', '.join(sorted(set(dropped)))))
+    if regressions or dropped:
+        sys.exit(1)
+
+if __name__=='__main__':
+    main()
@@ -11,10 +11,33 @@ import json
 import requests
 import subprocess
 import collections
+import concurrent.futures
+import contextlib
+import errno
+import fcntl
+import hashlib
+import heapq
+import mmap
+import stat
+import threading
 import re
 import argparse
+from encode_metrics import Metrics, RATE_BUCKETS
+from encode_profiler import Profiler
+from encode_metadata import write_metadata_org
+from encode_utils import write_file_atomic
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
 
 ENCODE_BASE_URL = 'https://www.encodeproject.org'
+MAX_CONCURRENT_SEARCHES = 8
+HASH_BUFFER_SIZE = 16*1024*1024
+# retries of portal requests back off exponentially up to this (seconds)
+MAX_RETRY_DELAY = 120
+# seconds to wait for a reader of a completion events FIFO at the end of a run
+FIFO_READER_TIMEOUT = 10
 
 def parse_arguments():
     parser = argparse.ArgumentParser(prog='ENCODE downloader',
@@ -66,6 +89,57 @@ def parse_arguments():
     parser.add_argument('--assembly-map', nargs='+', default=['Mus+musculus:mm10','Homo+sapiens:GRCh38'], type=str,
                             help='List of strings to infer ENCODE assembly from species name; [SPECIES_NAME]:[ASSEMBLY]. \
                             e.g. --assembly-map Mus+musculus:mm10 Homo+sapiens:GRCh38')
+    parser.add_argument('--filter-on-portal', action='store_true',
+                            help='Send --file-types, --assemblies and status filters to the portal \
+                            with a single file search per experiment, so that non-matching files are never fetched.')
+    parser.add_argument('--metadata-cache-dir', type=str,
+                            help='Keep experiment and file JSON from the portal in this directory \
+                            and read them from it on later runs instead of the portal \
+                            (e.g. to repeat --dry-run of a large query). Search results for inputs are not cached. \
+                            Remove the directory to get fresh metadata.')
+    parser.add_argument('--encode-base-url', default=ENCODE_BASE_URL, type=str,
+                            help='Base URL of the ENCODE portal (e.g. a mirror or a local mock portal).')
+    parser.add_argument('--metrics-json', type=str,
+                            help='Append metrics (counters, histograms, phase timings) as a JSON line to this file periodically.')
+    parser.add_argument('--metrics-prom', type=str,
+                            help='Write metrics to this Prometheus textfile periodically \
+                            (e.g. for node exporter\'s textfile collector; use a .prom extension).')
+    parser.add_argument('--metrics-interval', type=float, default=60.0,
+                            help='Interval in seconds for --metrics-json and --metrics-prom.')
+    parser.add_argument('--profile', action='store_true',
+                            help='Profile time of each phase and write a report to --profile-dir.')
+    parser.add_argument('--profile-cprofile', action='store_true',
+                            help='With --profile, also run cProfile for each phase and write [PHASE].pstats.')
+    parser.add_argument('--profile-memory', action='store_true',
+                            help='With --profile, also track peak memory per experiment with tracemalloc. \
+                            This slows down the run, so timings taken with it are inflated.')
+    parser.add_argument('--profile-dir', type=str, default='profile',
+                            help='Output directory for --profile.')
+    parser.add_argument('--profile-top-n', type=int, default=20,
+                            help='Number of functions/experiments shown in the profile report.')
+    parser.add_argument('--shard', type=parse_shard,
+                            help='i/N: Download shard i (1-based) out of N, for N nodes sharing [WORK_DIR]. \
+                            Each shard writes [WORK_DIR]/all_files.shard-i-of-N.json instead of all_files.tsv. \
+                            Merge them with merge_shards.py.')
+    parser.add_argument('--shard-by', choices=['experiment','file'], default='experiment',
+                            help='Partition experiments (by accession ID) or files (balanced by file_size) over shards. \
+                            With file, every shard fetches metadata of all experiments to make the same plan.')
+    parser.add_argument('--completion-events-file', type=str,
+                            help='Append a JSON line (event) to this file when all selected files \
+                            of an experiment are downloaded and verified (status: complete), \
+                            when any of them failed or the experiment is not accessible (status: failed) \
+                            or when no file is selected (status: no_files). Can be a FIFO (mkfifo). \
+                            Consumed by generate_pipeline_run_sh.py --watch-events.')
+    parser.add_argument('--on-complete-cmd', type=str,
+                            help='Shell command run on each completion event with environment variables \
+                            ENCODE_EVENT_STATUS, ENCODE_ACCESSION_ID, ENCODE_EXP_DIR and ENCODE_EVENT (JSON).')
+    parser.add_argument('--verify-md5-on-complete', action='store_true',
+                            help='Check md5 of files (in addition to size) before a completion event.')
+    parser.add_argument('--compact-metadata', action='store_true',
+                            help='Write the original experiment JSON gzipped without indentation \
+                            ([WORK_DIR]/[ACCESSION_ID]/metadata.org.json.gz) with a small index of fields \
+                            used by generate_pipeline_run_sh.py (metadata.index.json), \
+                            instead of metadata.org.json.')
     group_ignore_status = parser.add_mutually_exclusive_group()
     group_ignore_status.add_argument('--ignore-released', action='store_true', \
                             help='Ignore released data (except fastqs).')
@@ -77,6 +151,9 @@ def parse_arguments():
         not args.encode_access_key_id and args.encode_secret_key:
         print("Both parameters --encode-access-key-id and --encode-secret-key must be specified together.")
         raise ValueError
+    if args.shard and args.shard_by=='file' and \
+        (args.completion_events_file or args.on_complete_cmd):
+        raise Exception('Completion events are per experiment. They cannot be used with --shard-by file.')
     args.dir = os.path.abspath(args.dir)
     # make file_types lowercase
     for i, file_type in enumerate(args.file_types):
@@ -87,14 +164,14 @@ def parse_arguments():
             args.assemblies[i] = 'GRCh38'
     return args
 
-def is_encode_url( url ):
-    return url.startswith(ENCODE_BASE_URL)
+def is_encode_url( url, base_url=ENCODE_BASE_URL ):
+    return url.startswith(base_url)
 
-def is_encode_search_query_url( url ):
-    return url.startswith(ENCODE_BASE_URL+'/search/?')
+def is_encode_search_query_url( url, base_url=ENCODE_BASE_URL ):
+    return url.startswith(base_url+'/search/?')
 
-def is_encode_exp_url( url ):
-    return url.startswith(ENCODE_BASE_URL+'/experiments/ENCSR')
+def is_encode_exp_url( url, base_url=ENCODE_BASE_URL ):
+    return url.startswith(base_url+'/experiments/ENCSR')
 
 def get_accession_id_from_encode_exp_url( url ):    
     for s in url.split('/')[-2:]:
@@ -107,6 +184,43 @@ def is_file_type_fastq( file_type ):
 def is_file_type_bam( file_type ):
     return file_type.lower() in ['bam']
 
+def mkdir_p( path ):
+    if os.path.isdir(path): return
+    try:
+        os.makedirs(path)
+    except OSError:
+        # created by another thread/process in the meantime
+        if not os.path.isdir(path): raise
+
+def get_file_size( path ):
+    # None if not exists
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return None
+
+def md5sum_file( path ):
+    md5 = hashlib.md5()
+    with open(path,'rb') as fp:
+        if os.fstat(fp.fileno()).st_size==0:
+            return md5.hexdigest()
+        # memory-mapped to avoid copying file contents through read()
+        m = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            with memoryview(m) as mv:
+                for pos in range(0, len(mv), HASH_BUFFER_SIZE):
+                    md5.update(mv[pos:pos+HASH_BUFFER_SIZE])
+        finally:
+            m.close()
+    return md5.hexdigest()
+
+def is_file_complete( f, check_md5=False ):
+    # f: file record from ENCODEDownloader.iter_files()
+    size = get_file_size(f['filename'])
+    if size is None or f['file_size'] and size!=f['file_size']:
+        return False
+    return not check_md5 or not f['md5sum'] or md5sum_file(f['filename'])==f['md5sum']
+
 def get_accession_ids( accession_ids_file ):
     accession_ids = []
     if accession_ids_file and os.path.isfile(accession_ids_file):
@@ -135,6 +249,46 @@ def deep_search(json, s, help_str='root',debug=False):
             pass
     return ret
 
+def get_bio_rep_id( f ):
+    if 'replicate' in f and 'biological_replicates_number'in f['replicate']:
+        return f['replicate']['biological_replicate_number']
+    else: # 'biological_replicates'in f:
+        return f['biological_replicates']
+
+def get_shard( key, num_shards ):
+    # deterministic on all nodes (unlike hash())
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest(), 16) % num_shards
+
+def parse_shard( shard ):
+    # "i/N" (1-based) -> (i-1, N)
+    try:
+        i, n = [int(x) for x in shard.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('--shard must be i/N (e.g. 1/4).')
+    if n<1 or i<1 or i>n:
+        raise argparse.ArgumentTypeError('--shard i/N requires 1<=i<=N.')
+    return (i-1, n)
+
+def get_shard_manifest_file( work_dir, shard ):
+    return '{}/all_files.shard-{}-of-{}.json'.format(work_dir, shard[0]+1, shard[1])
+
+@contextlib.contextmanager
+def locked( lock_file ):
+    # exclusive lock shared by all nodes (on a filesystem supporting flock)
+    with open(lock_file, 'a') as fp:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+def get_request_type( url, base_url=ENCODE_BASE_URL ):
+    path = url[len(base_url):] if url.startswith(base_url) else url
+    if path.startswith('/search/'): return 'search'
+    if path.startswith('/experiments/'): return 'experiment'
+    if path.startswith('/files/'): return 'file'
+    return 'other'
+
 def get_depth_one( json_obj ):
     result = {}
        # add info to metadata json
@@ -144,271 +298,848 @@ def get_depth_one( json_obj ):
             result[key] = val
     return result
 
-def main():
-    args = parse_arguments()
+def write_all_files_tsv(tsv_file, all_file_metadata):
+    # count max. number of files per exp. accession
+    max_num_files = max( [len(all_file_metadata[acc_id]) for acc_id in all_file_metadata] )
+    # table header
+    header = 'accession\t'+\
+        'description(comma-delimited; file_acc_id:status:file_type:file_format:output_type:bio_rep_id:pair,...)\tfile'+ \
+        '\tfile'.join([str(i+1) for i in range(max_num_files)]) + '\n'
+    contents = ''
+    # table contents        
+    for accession_id in all_file_metadata:
+        file_metadata = all_file_metadata[accession_id]
+        desc = ''
+        tmp_cnt = 0
+        for file_acc_id in file_metadata:
+            tmp_cnt += 1
+            metadata = file_metadata[file_acc_id]
+            desc += ':'.join(   [file_acc_id,
+                                metadata['status'],
+                                metadata['file_type'],
+                                metadata['file_format'],
+                                metadata['output_type'],
+                                metadata['file_type'],
+                                '_'.join(str(x) for x in metadata['bio_rep_id']),
+                                str(metadata['pair']) ])
+            if tmp_cnt<len(file_metadata):
+                desc += ','
+        files = '\t'.join( [file_metadata[a]['rel_file'] for a in file_metadata] )
+        contents += '\t'.join([accession_id,desc,files]) + '\n'
+    with open(tsv_file,mode='w') as fp:
+        fp.write(header)
+        fp.write(contents)
 
-    # read ignored accession ids
-    ignored_accession_ids = get_accession_ids( args.ignored_accession_ids_file )
+def parse_file_type( f ):
+    # file JSON from portal -> (file_type, file_format, output_type)
+    arr = f['file_type'].lower().split(' ')
+    if len(arr)>1:
+        file_type = arr[0]
+        file_format = arr[1]
+    else:
+        file_type = arr[0]
+        file_format = file_type
+    output_type = f['output_type'].lower() #.replace(' ','_')
+    return file_type, file_format, output_type
 
-    HEADERS = {'accept': 'application/json'}
-    if args.encode_access_key_id: # if ENCODE key is given
-        encode_auth = (args.encode_access_key_id, args.encode_secret_key)
-    accession_ids = []
-    # process multiple inputs
-    for url_or_file in args.url_or_file:
-        if is_encode_search_query_url(url_or_file):
-            if not 'limit=all' in url_or_file:
-                url_or_file += '&limit=all'
-            if not 'format=json' in url_or_file:
-                url_or_file += '&format=json'
-            # send query to ENCODE portal and parse
-            if args.encode_access_key_id: # if ENCODE key is given
-                search_data = requests.get(url_or_file, headers=HEADERS, auth=encode_auth)
+class FileFilter(object):
+    '''
+    Selection criteria (--file-types, --assemblies, status and --pooled-rep-only)
+    compiled once into hashed lookups. Call it with a file JSON from the portal.
+    '''
+    # values are matched case-sensitively on the portal but case-insensitively here,
+    # so only values with known casing on the portal are pushed down
+    PORTAL_FILE_FORMATS = dict((v.lower(), v) for v in [
+        'fastq', 'bam', 'sam', 'bed', 'bigBed', 'bigWig', 'wig', 'tagAlign', 'bedpe',
+        'gtf', 'gff', 'tsv', 'csv', 'txt', 'vcf', 'hic', 'hdf5', 'fasta', 'sra', 'tar'])
+    PORTAL_OUTPUT_TYPES = dict((v.lower(), v) for v in [
+        'reads', 'alignments', 'unfiltered alignments', 'signal p-value',
+        'fold change over control', 'signal of unique reads', 'signal of all reads',
+        'raw signal', 'read-depth normalized signal', 'peaks', 'replicated peaks',
+        'stable peaks', 'pseudoreplicated peaks', 'hotspots', 'IDR thresholded peaks',
+        'conservative IDR thresholded peaks', 'optimal IDR thresholded peaks',
+        'pseudoreplicated IDR thresholded peaks', 'IDR ranked peaks',
+        'gene quantifications', 'transcript quantifications'])
+
+    def __init__(self, file_types=['fastq'], assemblies=['all'], pooled_rep_only=False,
+                ignore_released=False, ignore_unpublished=False):
+        self.all_file_types = False
+        self.file_types = set() # file_type
+        self.pairs = set() # (file_type or file_format, file_format or output_type)
+        self.triples = set() # (file_type, file_format, output_type)
+        for ft in file_types:
+            arr = ft.lower().split(':')
+            if len(arr)>2:
+                self.triples.add(tuple(arr[:3]))
+            elif len(arr)>1:
+                self.pairs.add(tuple(arr))
+            elif arr[0]=='all':
+                self.all_file_types = True
             else:
-                search_data = requests.get(url_or_file, headers=HEADERS)    
-            json_data_search = search_data.json() #json.loads(search_data)
-            for item in json_data_search['@graph']:
-                accession_id = item['accession']
-                accession_ids.append(accession_id)
-        elif is_encode_exp_url(url_or_file):
-            accession_id = get_accession_id_from_encode_exp_url(url_or_file)
-            accession_ids.append( accession_id )
-        elif os.path.exists(url_or_file) and os.path.isfile(url_or_file):
-            accession_ids += get_accession_ids( url_or_file )
-        elif url_or_file.startswith('ENCSR'):
-            accession_ids.append(url_or_file)
-        else:
-            print("Only URL, accession_ids_file or accession_id is allowed for input ({}).".format(url_or_file))
-            raise ValueError
-    print(accession_ids)
-
-    os.system('mkdir -p {}'.format(args.dir))
-    # ordered dict to write metadata table (including all accessions)
-    all_file_metadata = collections.OrderedDict()
-    # download files for each accession id
-    for accession_id in accession_ids:
-        # get accession info
-        print("="*10+" "+accession_id+" "+"="*10)
-        if args.dry_run_list_accession_ids: continue
-        if ignored_accession_ids and accession_id in ignored_accession_ids: # ignore if in the black list
-            print('\tignored (--ignored-accession-ids-file)')
-            continue
-        if accession_ids and not accession_id in accession_ids:
-            print('\tnot in the list (--accession-ids-file)')
-            continue
-        # get json from ENCODE portal for accession id
-        if args.encode_access_key_id: # if ENCODE key is given
-            search_data = requests.get(ENCODE_BASE_URL+'/experiments/'+accession_id+'?format=json',
-                headers=HEADERS, auth=encode_auth)
-        else:
-            search_data = requests.get(ENCODE_BASE_URL+'/experiments/'+accession_id+'?format=json',
-                headers=HEADERS)
-        json_data_exp = search_data.json()  
+                self.file_types.add(arr[0])
+        assemblies = ['GRCh38' if assembly=='hg38' else assembly for assembly in assemblies]
+        self.assemblies = None if 'all' in assemblies else set(assemblies)
+        self.pooled_rep_only = pooled_rep_only
+        self.ignore_released = ignore_released
+        self.ignore_unpublished = ignore_unpublished
 
-        if json_data_exp['status']=='error':
-            print("Error: cannot access to accession {}".format(accession_id))
-            print(json_data_exp)
-            continue
-        assembly = None
-        if not assembly: # infer assembly from organism name...
-            for s in args.assembly_map:
-                arr = s.replace('+',' ').split(':')
-                if deep_search(json_data_exp, arr[0]):
-                    assembly = arr[1]
-                    # print('Warning: inferred assembly ({}) from keys and values in json (e.g. organism name)...'.format(assembly))
-                    break
-        if 'assay_category' in json_data_exp:        
-            assay_category = json_data_exp['assay_category']
-        else:
-            assay_category = None
-        # read files in accession
-        downloaded_this_exp_accession = False
-        
-        # init metadata object
-        metadata = get_depth_one(json_data_exp)
-        metadata['files'] = {} # file info
-        for org_f in json_data_exp['original_files']:
-            # if args.encode_access_key_id: # if ENCODE key is given
-            #     search_file = requests.get(ENCODE_BASE_URL+org_f+'?format=json',headers=HEADERS,auth=encode_auth)
-            # else:
-            #     search_file = requests.get(ENCODE_BASE_URL+org_f+'?format=json',headers=HEADERS)
-            retry_cnt = 0
+    def match_file_type(self, file_type, file_format, output_type):
+        if self.all_file_types or file_type in self.file_types:
+            return True
+        if self.triples and (file_type, file_format, output_type) in self.triples:
+            return True
+        if self.pairs:
+            for a in (file_type, file_format):
+                if (a, file_format) in self.pairs or (a, output_type) in self.pairs:
+                    return True
+        return False
+
+    def __call__(self, f):
+        status = f['status'].lower().replace(' ','_')
+        if status=='error':
+            return False
+        if self.ignore_released and status=='released': return False
+        if self.ignore_unpublished and status!='released': return False
+        file_type, file_format, output_type = parse_file_type(f)
+        if not self.match_file_type(file_type, file_format, output_type):
+            return False
+        if self.pooled_rep_only:
+            bio_rep_id = get_bio_rep_id(f)
+            if type(bio_rep_id)==list and len(bio_rep_id)<2:
+                return False
+        if file_type!='fastq' and self.assemblies is not None and \
+            not f.get('assembly','') in self.assemblies:
+            return False
+        return True
+
+    def get_portal_query(self):
+        '''
+        Returns a list of (key, value) for the portal's file search that
+        can only narrow down files this filter would reject anyway.
+        '''
+        query = []
+        if self.ignore_unpublished:
+            query.append(('status', 'released'))
+        elif self.ignore_released:
+            query.append(('status!', 'released'))
+        # file_type:output_type can match file_format instead of file_type, so
+        # file_format can only be pushed down for file_type and file_type:file_format:output_type
+        if self.all_file_types or self.pairs:
+            return query
+        # a value with unknown casing could miss files on the portal,
+        # so its key is not pushed down at all (values of a key are OR-ed)
+        file_formats = self.file_types | set(t[0] for t in self.triples)
+        if all(file_format in self.PORTAL_FILE_FORMATS for file_format in file_formats):
+            for file_format in sorted(file_formats):
+                query.append(('file_format', self.PORTAL_FILE_FORMATS[file_format]))
+        output_types = set(t[2] for t in self.triples)
+        if not self.file_types and \
+            all(output_type in self.PORTAL_OUTPUT_TYPES for output_type in output_types):
+            for output_type in sorted(output_types):
+                query.append(('output_type', self.PORTAL_OUTPUT_TYPES[output_type]))
+        # fastqs have no assembly
+        if self.assemblies is not None and not 'fastq' in file_formats:
+            for assembly in sorted(self.assemblies):
+                query.append(('assembly', assembly))
+        return query
+
+class ENCODEDownloader(object):
+    '''
+    Python API behind the command line interface.
+    All portal requests go through one HTTP session and a JSON cache.
+
+        with ENCODEDownloader(work_dir='data', file_types=['fastq']) as downloader:
+            for accession_id in downloader.iter_accession_ids(['ENCSR000ELE']):
+                for f in downloader.iter_files(accession_id):
+                    future = downloader.submit(f)
+    '''
+    HEADERS = {'accept': 'application/json'}
+
+    def __init__(self, work_dir='.', file_types=['fastq'], assemblies=['all'],
+                encode_access_key_id=None, encode_secret_key=None,
+                pooled_rep_only=False, dry_run=False, max_download=8,
+                ignore_released=False, ignore_unpublished=False,
+                filter_on_portal=False, base_url=ENCODE_BASE_URL, metrics=None,
+                shard=None, shard_by='experiment', on_complete=None, verify_md5_on_complete=False,
+                compact_metadata=False, metadata_cache_dir=None):
+        self.work_dir = os.path.abspath(work_dir)
+        self.base_url = base_url.rstrip('/')
+        self.file_filter = FileFilter(file_types, assemblies, pooled_rep_only,
+                                    ignore_released, ignore_unpublished)
+        self.filter_on_portal = filter_on_portal
+        self.dry_run = dry_run
+        # (0-based shard index, number of shards)
+        self.shard = shard
+        self.shard_by = shard_by
+        self.file_shards = None # file_acc_id: shard index (--shard-by file)
+        self.file_plan = None # accession_id: [file (dict from iter_files) in this shard] (--shard-by file)
+        self.plan_digest = None # same on all shards if they made the same plan
+        # called with an event (dict) when all files of an experiment are done
+        self.on_complete = on_complete
+        self.verify_md5_on_complete = verify_md5_on_complete
+        # metadata.org.json.gz with metadata.index.json instead of metadata.org.json
+        self.compact_metadata = compact_metadata
+        self.encode_access_key_id = encode_access_key_id
+        self.encode_secret_key = encode_secret_key
+
+        self.session = requests.Session()
+        self.session.headers.update(self.HEADERS)
+        if encode_access_key_id: # if ENCODE key is given
+            self.session.auth = (encode_access_key_id, encode_secret_key)
+        self.json_cache = {}
+        # on-disk JSON cache ([DIR]/[XX]/[MD5_OF_URL].json) kept across runs
+        self.metadata_cache_dir = os.path.abspath(metadata_cache_dir) if metadata_cache_dir else None
+        self.created_dirs = set()
+        # number of files, bytes and files without file_size submitted: to download or already downloaded
+        self.planned = collections.OrderedDict([('download', [0, 0, 0]), ('exists', [0, 0, 0])])
+        self.metrics = metrics if metrics is not None else Metrics()
+        # parallel downloading is disabled with authentication (curl)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1 if encode_access_key_id else max_download)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        # wait for all submitted downloads
+        with self.metrics.phase('wait_downloads'):
+            self.executor.shutdown(wait=True)
+        self.session.close()
+
+    def get_json(self, url, disk_cache=True):
+        request_type = get_request_type(url, self.base_url)
+        if url in self.json_cache:
+            self.metrics.inc('encode_json_cache_hits_total', type=request_type)
+            return self.json_cache[url]
+        cache_file = self.get_cache_file(url) if disk_cache else None
+        if cache_file and os.path.exists(cache_file):
+            with self.metrics.phase('read_metadata_cache'):
+                with open(cache_file, 'r') as fp:
+                    json_data = json.load(fp)
+            self.metrics.inc('encode_json_disk_cache_hits_total', type=request_type)
+            self.json_cache[url] = json_data
+            return json_data
+        retry_cnt = 0
+        with self.metrics.phase('fetch_metadata'):
             while True:
+                t0 = time.time()
                 try:
-                    if args.encode_access_key_id: # if ENCODE key is given
-                        search_file = requests.get(ENCODE_BASE_URL+org_f+'?format=json',headers=HEADERS,auth=encode_auth)
-                    else:
-                        search_file = requests.get(ENCODE_BASE_URL+org_f+'?format=json',headers=HEADERS)
-                except:
-                    print('Exception caught, retrying in 120 seconds...')
+                    response = self.session.get(url)
+                    # server errors are transient: an error JSON must not be taken as metadata
+                    if response.status_code>=500 or response.status_code==429:
+                        raise Exception('HTTP {}'.format(response.status_code))
+                    json_data = response.json()
+                except Exception as e:
+                    self.metrics.inc('encode_portal_request_failures_total', type=request_type)
+                    delay = min(MAX_RETRY_DELAY, 2**retry_cnt)
+                    print('Exception caught ({}: {}), retrying in {} seconds...'.format(url, e, delay))
                 else:
                     break
                 retry_cnt += 1
                 if retry_cnt>100:
                     raise Exception('Exceeded maximum number of retries {}. Aborting...'.format(retry_cnt-1))
                 print('Retrial: {}'.format(retry_cnt))
-                time.sleep(120)
-
-            f = search_file.json()
-            status = f['status'].lower().replace(' ','_')
-            if status=='error': continue
-            file_assembly = f['assembly'] if 'assembly' in f else ''
-            arr = f['file_type'].lower().split(' ')
-            if len(arr)>1:
-                file_type = arr[0]
-                file_format = arr[1]
-            else:
-                file_type = arr[0]
-                file_format = file_type                
-            output_type = f['output_type'].lower() #.replace(' ','_')
-            valid = ('all' in args.file_types)
-            for ft in args.file_types:
-                arr = ft.split(':')
-                if len(arr)>2:
-                    if file_type==arr[0] and file_format==arr[1] and output_type==arr[2]:
-                        valid = True
-                        break                    
-                elif len(arr)>1:
-                    if (file_type==arr[0] or file_format==arr[0]) and \
-                        (file_format==arr[1] or output_type==arr[1]):
-                        valid = True
-                        break
-                else:                    
-                    if file_type==arr[0]:
-                        valid = True
-                        break
-            if not valid: continue            
-            url_file = ENCODE_BASE_URL+f['href']
-            file_accession_id = f['accession']
-
-            if args.ignore_released and status=='released': continue
-            if args.ignore_unpublished and status!='released': continue
-            if 'paired_end' in f:
-                pair = int(f['paired_end']) 
-            else:
-                pair = -1
-            if 'replicate' in f and 'biological_replicates_number'in f['replicate']:
-                bio_rep_id = f['replicate']['biological_replicate_number']
-            else: # 'biological_replicates'in f:
-                bio_rep_id = f['biological_replicates']
-            if 'replicate' in f and 'technical_replicate_number'in f['replicate']:
-                tech_rep_id = f['replicate']['technical_replicate_number']
-            else: #if 'technical_replicates' in f:
-                tech_rep_id = f['technical_replicates']
-            if type(tech_rep_id)==list and len(tech_rep_id)>0:
-                tech_rep_id=tech_rep_id[0]
-            else:
-                tech_rep_id=tech_rep_id            
-            if args.pooled_rep_only and type(bio_rep_id)==list and len(bio_rep_id)<2:
-                continue
-            # print(file_accession_id, file_assembly, file_type, file_format, output_type, bio_rep_id, tech_rep_id, pair)
-            if file_type == 'fastq':
-                # if tech_rep_id != '1' and tech_rep_id != 1: break;
-                pass
-            else:
-                if not 'all' in args.assemblies and not file_assembly in args.assemblies: continue
-            # create directory for downloading
-            dir_suffix = accession_id+'/'+status+'/'+file_assembly+'/'+output_type.replace(' ', '_')+'/'+file_type.replace(' ', '_')
-            if file_type!=file_format: dir_suffix += '/'+file_format
-            # if bio_rep_id>0: dir_suffix += '/rep'+str(bio_rep_id)
-            if bio_rep_id:
-                dir_suffix += '/rep'+'_rep'.join([str(i) for i in bio_rep_id])
-            if pair>0: dir_suffix += '/pair'+str(pair)
-            dir = args.dir+'/' + dir_suffix
-
-            # print file_accession_id, file_assembly, file_type, file_format, output_type, bio_rep_id, tech_rep_id, pair, dir
-            # continue
-
-            if not args.dry_run:
-                os.system('mkdir -p {}'.format(dir))
-            # continue
-            # check number of downloading files
-            # while int(subprocess.check_output('ps aux | grep wget | wc -l', shell=True).strip('\n')) \
-            while int(subprocess.check_output('ps aux | grep wget | wc -l', shell=True)) \
-                        > args.max_download-1:
-                print('# of downloads exceeded the limit ({}), retrying in 20 seconds...'.format(args.max_download))
-                time.sleep(20)
-
-            # download file
-            basename = url_file.split("/")[-1]
-            filename = '{}/{}'.format(dir,basename)
-            if os.path.exists(filename):
-                print('File exists ({}): {}, rep:{}, pair:{}'.format(file_type, url_file, bio_rep_id, pair))
-            elif args.dry_run:
-                print('Dry-run ({}): {}, rep:{}, pair:{}'.format(file_type, url_file, bio_rep_id, pair))
+                self.metrics.inc('encode_portal_retries_total', type=request_type)
+                time.sleep(delay)
+        self.metrics.observe('encode_portal_request_seconds', time.time()-t0, type=request_type)
+        self.metrics.inc('encode_portal_requests_total', type=request_type, code=response.status_code)
+        self.metrics.inc('encode_portal_response_bytes_total', len(response.content), type=request_type)
+        if not response.ok:
+            # e.g. 403 for unpublished files without authentication, 404 for a wrong accession.
+            # returned to the caller (status: error) but not cached
+            print('HTTP {}: {}'.format(response.status_code, url))
+            return json_data
+        self.json_cache[url] = json_data
+        if cache_file:
+            mkdir_p(os.path.dirname(cache_file))
+            write_file_atomic(cache_file, response.text)
+        return json_data
+
+    def get_cache_file(self, url):
+        if not self.metadata_cache_dir:
+            return None
+        key = hashlib.md5(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.metadata_cache_dir, key[:2], key+'.json')
+
+    def clear_cache(self):
+        # for a long-lived downloader, e.g. between batches
+        self.json_cache.clear()
+
+    def evict_experiment(self, accession_id, json_data_exp):
+        # experiment and file JSON are not needed after an experiment is submitted
+        self.json_cache.pop(self.get_experiment_url(accession_id), None)
+        file_ids = list(json_data_exp.get('original_files', []))
+        json_data_search = self.json_cache.pop(self.get_file_search_url(accession_id), None)
+        if json_data_search:
+            file_ids += [f['@id'] for f in json_data_search['@graph']]
+        for file_id in file_ids:
+            self.json_cache.pop(self.get_file_url(file_id), None)
+
+    def get_experiment_url(self, accession_id):
+        return self.base_url+'/experiments/'+accession_id+'?format=json'
+
+    def get_file_url(self, file_id):
+        # file_id: /files/[file_acc_id]/
+        return self.base_url+file_id+'?format=json'
+
+    def get_file_search_url(self, accession_id):
+        query = [('type', 'File'), ('dataset', '/experiments/{}/'.format(accession_id))]
+        query += self.file_filter.get_portal_query()
+        query += [('frame', 'object'), ('limit', 'all'), ('format', 'json')]
+        return self.base_url+'/search/?'+urlencode(query)
+
+    def iter_accession_ids(self, url_or_files, ignored_accession_ids=()):
+        accession_ids, _ = self.resolve_inputs(url_or_files, ignored_accession_ids)
+        for accession_id in accession_ids:
+            yield accession_id
+
+    def resolve_inputs(self, url_or_files, ignored_accession_ids=()):
+        '''
+        Resolves search URLs concurrently and merges them with experiment URLs,
+        accession ids files and accession ids, in input order without duplicates.
+        Returns (accession_ids, counts) where counts is a list of
+        (url_or_file, num_accession_ids, num_new, num_ignored) for each input.
+        '''
+        with self.metrics.phase('resolve_inputs'):
+            return self._resolve_inputs(url_or_files, ignored_accession_ids)
+
+    def _resolve_inputs(self, url_or_files, ignored_accession_ids):
+        search_urls = {}
+        for url_or_file in url_or_files:
+            if is_encode_search_query_url(url_or_file, self.base_url):
+                url = url_or_file
+                if not 'limit=all' in url:
+                    url += '&limit=all'
+                if not 'format=json' in url:
+                    url += '&format=json'
+                search_urls[url_or_file] = url
+            elif not is_encode_exp_url(url_or_file, self.base_url) and \
+                not (os.path.exists(url_or_file) and os.path.isfile(url_or_file)) and \
+                not url_or_file.startswith('ENCSR'):
+                print("Only URL, accession_ids_file or accession_id is allowed for input ({}).".format(url_or_file))
+                raise ValueError
+        # send all queries to ENCODE portal at once
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, min(MAX_CONCURRENT_SEARCHES, len(search_urls)))) as executor:
+            search_results = dict(zip(search_urls,
+                executor.map(lambda url: self.get_json(url, disk_cache=False), search_urls.values())))
+
+        ignored_accession_ids = set(ignored_accession_ids)
+        # ordered dict as an ordered set
+        result = collections.OrderedDict()
+        counts = []
+        for url_or_file in url_or_files:
+            if url_or_file in search_results:
+                ids = [item['accession'] for item in search_results[url_or_file]['@graph']]
+            elif is_encode_exp_url(url_or_file, self.base_url):
+                ids = [get_accession_id_from_encode_exp_url(url_or_file)]
+            elif os.path.exists(url_or_file) and os.path.isfile(url_or_file):
+                ids = get_accession_ids( url_or_file )
             else:
-                print('Downloading ({}): {}, rep:{}, pair:{}'.format(file_type, url_file, bio_rep_id, pair))
-                if args.encode_access_key_id:
-                    cmd_curl = 'curl -RL -u {}:{} {} -o {}'.format(args.encode_access_key_id,
-                            args.encode_secret_key, url_file, filename)
-                    os.system(cmd_curl)
-                else:
-                    cmd_wget = 'wget -bqcN -P {} {}'.format(dir,url_file)
-                    os.system(cmd_wget)
-                    time.sleep(0.25) # wait for 0.25 second per fastq
+                ids = [url_or_file]
+            num_new = 0
+            num_ignored = 0
+            for accession_id in ids:
+                if accession_id in ignored_accession_ids:
+                    num_ignored += 1
+                elif accession_id not in result:
+                    result[accession_id] = None
+                    num_new += 1
+            counts.append((url_or_file, len(ids), num_new, num_ignored))
+        return list(result), counts
+
+    def get_experiment(self, accession_id):
+        # get json from ENCODE portal for accession id
+        json_data_exp = self.get_json(self.get_experiment_url(accession_id))
+        if json_data_exp['status']=='error':
+            print("Error: cannot access to accession {}".format(accession_id))
+            print(json_data_exp)
+            return None
+        return json_data_exp
+
+    def iter_file_jsons(self, accession_id, json_data_exp):
+        if not self.filter_on_portal:
+            for org_f in json_data_exp['original_files']:
+                yield self.get_json(self.get_file_url(org_f))
+            return
+        # one search for all files of the experiment instead of one request per file
+        json_data_search = self.get_json(self.get_file_search_url(accession_id))
+        # keep the order of original_files
+        order = dict((org_f, i) for i, org_f in enumerate(json_data_exp['original_files']))
+        for f in sorted(json_data_search['@graph'],
+                        key=lambda f: order.get(f['@id'], len(order))):
+            self.json_cache[self.get_file_url(f['@id'])] = f
+            yield f
+
+    def iter_files(self, accession_id, json_data_exp=None):
+        '''
+        Yields a dict for each file in an experiment matching file types,
+        assemblies and status. Nothing is created or downloaded here.
+        '''
+        if json_data_exp is None:
+            json_data_exp = self.get_experiment(accession_id)
+            if json_data_exp is None: return
+        for f in self.iter_file_jsons(accession_id, json_data_exp):
+            with self.metrics.phase('filter'):
+                record = self.get_file_record(accession_id, f)
+            if record is not None:
+                self.metrics.inc('encode_files_selected_total')
+                yield record
+
+    def get_file_record(self, accession_id, f):
+        '''
+        Returns a dict for a file JSON from the portal or None if filtered out.
+        '''
+        if not self.file_filter(f): return None
+        status = f['status'].lower().replace(' ','_')
+        file_assembly = f['assembly'] if 'assembly' in f else ''
+        file_type, file_format, output_type = parse_file_type(f)
+        url_file = self.base_url+f['href']
+        if 'paired_end' in f:
+            pair = int(f['paired_end']) 
+        else:
+            pair = -1
+        bio_rep_id = get_bio_rep_id(f)
+        # directory for downloading
+        dir_suffix = accession_id+'/'+status+'/'+file_assembly+'/'+output_type.replace(' ', '_')+'/'+file_type.replace(' ', '_')
+        if file_type!=file_format: dir_suffix += '/'+file_format
+        if bio_rep_id:
+            dir_suffix += '/rep'+'_rep'.join([str(i) for i in bio_rep_id])
+        if pair>0: dir_suffix += '/pair'+str(pair)
+        dir = self.work_dir+'/' + dir_suffix
+        basename = url_file.split("/")[-1]
+
+        # check if paired with other fastq                
+        paired_with = None
+        if file_type == 'fastq' and 'paired_with' in f:
+            paired_with = f['paired_with'].split('/')[2]
+
+        return dict(
+            accession_id=accession_id,
+            file_accession_id=f['accession'],
+            url=url_file,
+            dir=dir,
+            filename='{}/{}'.format(dir,basename),
+            # relative path for file (for pipeline)
+            rel_file=(self.work_dir + '/' + dir_suffix + '/' + basename).replace('//','/'),
+            file_type=file_type,
+            file_format=file_format,
+            output_type=output_type,
+            status=status,
+            bio_rep_id=bio_rep_id,
+            pair=pair,
+            paired_with=paired_with,
+            md5sum=f.get('md5sum'),
+            file_size=f.get('file_size'))
 
-            # relative path for file (for pipeline)            
-            rel_file = args.dir + '/' + dir_suffix + '/' + os.path.basename(url_file)
-            rel_file = rel_file.replace('//','/')
+    def submit(self, f):
+        '''
+        Submits a file (dict from iter_files) for downloading.
+        Returns a future whose result is one of 'exists', 'dry_run',
+        'downloaded' or 'failed'.
+        '''
+        with self.metrics.phase('dispatch'):
+            return self._submit(f)
 
-            # check if paired with other fastq                
-            paired_with = None
-            if file_type == 'fastq' and 'paired_with' in f:
-                paired_with = f['paired_with'].split('/')[2]
+    def _submit(self, f):
+        size = get_file_size(f['filename'])
+        # partially written files are resumed (wget -c)
+        exists = size is not None and (not f['file_size'] or size==f['file_size'])
+        planned = self.planned['exists' if exists else 'download']
+        planned[0] += 1
+        planned[1] += f['file_size'] or 0
+        planned[2] += 0 if f['file_size'] else 1
+        if exists:
+            print('File exists ({}): {}, rep:{}, pair:{}'.format(f['file_type'], f['url'], f['bio_rep_id'], f['pair']))
+            return self._done('exists')
+        elif self.dry_run:
+            print('Dry-run ({}): {}, rep:{}, pair:{}'.format(f['file_type'], f['url'], f['bio_rep_id'], f['pair']))
+            return self._done('dry_run')
+        self.mkdir_p(f['dir'])
+        print('Downloading ({}): {}, rep:{}, pair:{}'.format(f['file_type'], f['url'], f['bio_rep_id'], f['pair']))
+        self.metrics.add('encode_download_queue_depth', 1)
+        return self.executor.submit(self._download, f)
 
+    def get_plan_summary(self):
+        lines = []
+        for key, (num_files, size, num_unknown) in self.planned.items():
+            lines.append('{}: {} files, {} bytes ({:.3f} GB){}'.format(
+                'To download' if key=='download' else 'Already downloaded', num_files, size, size/1e9,
+                ' (file_size unknown for {} files)'.format(num_unknown) if num_unknown else ''))
+        return '\n'.join(lines)
+
+    def mkdir_p(self, path):
+        # remember created directories to skip a stat for each file
+        if path in self.created_dirs: return
+        with self.metrics.phase('mkdir'):
+            mkdir_p(path)
+        self.created_dirs.add(path)
+
+    def _done(self, result):
+        future = concurrent.futures.Future()
+        future.set_result(result)
+        return future
+
+    def _download(self, f):
+        self.metrics.add('encode_download_queue_depth', -1)
+        self.metrics.add('encode_downloads_active', 1)
+        size_before = get_file_size(f['filename']) or 0
+        t0 = time.time()
+        try:
+            result = self._run_download_cmd(f)
+        finally:
+            self.metrics.add('encode_downloads_active', -1)
+        elapsed = time.time()-t0
+        transferred = (get_file_size(f['filename']) or 0) - size_before
+        self.metrics.inc('encode_downloads_total', result=result)
+        self.metrics.inc('encode_download_seconds_total', elapsed)
+        if transferred>0:
+            self.metrics.inc('encode_download_bytes_total', transferred)
+            self.metrics.observe('encode_download_rate_bytes_per_second',
+                transferred/max(elapsed, 1e-6), buckets=RATE_BUCKETS)
+        return result
+
+    def _run_download_cmd(self, f):
+        if self.encode_access_key_id:
+            cmd = ['curl', '-RL', '-u', '{}:{}'.format(self.encode_access_key_id,
+                    self.encode_secret_key), f['url'], '-o', f['filename']]
+        else:
+            cmd = ['wget', '-qcN', '-P', f['dir'], f['url']]
+        # no shell
+        if subprocess.call(cmd):
+            print('Failed to download: {}'.format(f['url']))
+            return 'failed'
+        return 'downloaded'
+
+    def download_experiment(self, accession_id):
+        '''
+        Submits all matching files in an experiment and writes its metadata.
+        Returns (metadata, futures) or (None, []) if nothing matched.
+        Its experiment and file JSON are evicted from the cache afterwards.
+        '''
+        # peak memory of JSON held for an experiment (with --profile-memory)
+        with self.metrics.track_memory(accession_id):
+            return self._download_experiment(accession_id)
+
+    def _download_experiment(self, accession_id):
+        json_data_exp = self.get_experiment(accession_id)
+        if json_data_exp is None:
+            self.metrics.inc('encode_experiments_total', result='error')
+            # consumers waiting for this experiment must not wait forever
+            self.emit_event(accession_id, 'failed')
+            return None, []
+        try:
+            return self._submit_experiment(accession_id, json_data_exp)
+        finally:
+            self.evict_experiment(accession_id, json_data_exp)
+
+    def _submit_experiment(self, accession_id, json_data_exp):
+        # init metadata object
+        metadata = get_depth_one(json_data_exp)
+        metadata['files'] = {} # file info
+        futures = []
+        files = []
+        # files were already selected when shards were planned
+        if self.file_plan is not None:
+            selected = self.file_plan.get(accession_id, [])
+        else:
+            selected = self.iter_files(accession_id, json_data_exp)
+        for f in selected:
+            futures.append(self.submit(f))
+            files.append(f)
             # for fastq, store files with the same bio_rep_id and pair: these files will be pooled later in a pipeline
-            if bio_rep_id:                
-                metadata['files'][file_accession_id] = dict(
-                    file_type=file_type,
-                    file_format=file_format,
-                    output_type=output_type,
-                    status=status,
-                    bio_rep_id=bio_rep_id,
-                    pair=pair,
-                    paired_with=paired_with,
-                    rel_file=rel_file)
-            downloaded_this_exp_accession = True
-
-        if not args.dry_run and downloaded_this_exp_accession:
-            os.system('mkdir -p {}'.format(args.dir+'/'+accession_id))
-            with open(args.dir+'/'+accession_id+'/metadata.org.json',mode='w') as fp:
-                fp.write(json.dumps(json_data_exp, indent=4))
-            with open(args.dir+'/'+accession_id+'/metadata.json',mode='w') as fp:
-                fp.write(json.dumps(metadata, indent=4))
-            all_file_metadata[accession_id] = metadata['files']
+            if f['bio_rep_id']:
+                metadata['files'][f['file_accession_id']] = dict(
+                    file_type=f['file_type'],
+                    file_format=f['file_format'],
+                    output_type=f['output_type'],
+                    status=f['status'],
+                    bio_rep_id=f['bio_rep_id'],
+                    pair=f['pair'],
+                    paired_with=f['paired_with'],
+                    rel_file=f['rel_file'],
+                    md5sum=f['md5sum'],
+                    file_size=f['file_size'])
+        if not futures:
+            self.metrics.inc('encode_experiments_total', result='no_files')
+            self.emit_event(accession_id, 'no_files')
+            return None, []
+        self.metrics.inc('encode_experiments_total', result='ok')
+        if not self.dry_run:
+            self.mkdir_p(self.work_dir+'/'+accession_id)
+            with self.metrics.phase('write_metadata'):
+                self.write_metadata(accession_id, json_data_exp, metadata)
+            if self.on_complete:
+                self.watch_experiment(accession_id, files, futures)
+        return metadata, futures
+
+    def watch_experiment(self, accession_id, files, futures):
+        # fires an event once the last file of an experiment is done (in its download thread)
+        remaining = [len(futures)]
+        lock = threading.Lock()
+        def done(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]: return
+            self.complete_experiment(accession_id, files)
+        for future in futures:
+            future.add_done_callback(done)
+
+    def complete_experiment(self, accession_id, files):
+        with self.metrics.phase('verify'):
+            incomplete = [f['file_accession_id'] for f in files
+                if not is_file_complete(f, self.verify_md5_on_complete)]
+        self.emit_event(accession_id, 'failed' if incomplete else 'complete', files, incomplete)
+
+    def emit_event(self, accession_id, status, files=[], incomplete_files=[]):
+        '''
+        status: complete, failed (download/verification failed or no access to experiment)
+        or no_files (no file selected).
+        '''
+        if not self.on_complete or self.dry_run:
+            return
+        self.metrics.inc('encode_experiments_completed_total', status=status)
+        event = dict(
+            status=status,
+            accession_id=accession_id,
+            dir=self.work_dir+'/'+accession_id,
+            num_files=len(files),
+            incomplete_files=incomplete_files,
+            time=time.time())
+        try:
+            self.on_complete(event)
+        except Exception as e:
+            # never stop downloading other experiments
+            print('Failed to handle completion event ({}): {}'.format(accession_id, e))
+
+    def write_metadata(self, accession_id, json_data_exp, metadata):
+        exp_dir = self.work_dir+'/'+accession_id
+        if not self.file_shards:
+            write_metadata_org(exp_dir, json_data_exp, self.compact_metadata)
+            write_file_atomic(exp_dir+'/metadata.json', json.dumps(metadata, indent=4))
+            return
+        # files of an experiment are split over shards: merge with other shards' files
+        with locked(exp_dir+'/.metadata.lock'):
+            if os.path.exists(exp_dir+'/metadata.json'):
+                with open(exp_dir+'/metadata.json','r') as fp:
+                    files = json.load(fp)['files']
+                files.update(metadata['files'])
+                metadata = dict(metadata, files=files)
+            write_metadata_org(exp_dir, json_data_exp, self.compact_metadata)
+            write_file_atomic(exp_dir+'/metadata.json', json.dumps(metadata, indent=4))
+
+    def in_shard_experiment(self, accession_id):
+        if not self.shard or self.shard_by!='experiment':
+            return True
+        return get_shard(accession_id, self.shard[1])==self.shard[0]
+
+    def plan_file_shards(self, accession_ids):
+        '''
+        Assigns all selected files of all experiments to shards, balanced by file_size.
+        Every shard computes the same plan from the same inputs.
+        Files of this shard are kept for download_experiment(), so files are selected only once.
+        Returns {accession_id: [file_accession_id, ...]} for all selected files.
+        '''
+        file_order = collections.OrderedDict()
+        records = collections.OrderedDict()
+        files = []
+        for accession_id in accession_ids:
+            file_order[accession_id] = []
+            records[accession_id] = list(self.iter_files(accession_id))
+            for f in records[accession_id]:
+                file_order[accession_id].append(f['file_accession_id'])
+                files.append((f['file_size'] or 0, f['file_accession_id']))
+        # largest first to the least loaded shard
+        loads = [(0, i) for i in range(self.shard[1])]
+        file_shards = {}
+        for file_size, file_acc_id in sorted(files, key=lambda x: (-x[0], x[1])):
+            load, i = heapq.heappop(loads)
+            file_shards[file_acc_id] = i
+            heapq.heappush(loads, (load+file_size, i))
+        self.file_shards = file_shards
+        self.plan_digest = hashlib.md5(json.dumps([file_order, sorted(file_shards.items())])
+            .encode('utf-8')).hexdigest()
+        self.file_plan = dict((accession_id, [f for f in records[accession_id]
+            if file_shards[f['file_accession_id']]==self.shard[0]]) for accession_id in records)
+        return file_order
+
+def main():
+    args = parse_arguments()
+
+    # read ignored accession ids
+    ignored_accession_ids = get_accession_ids( args.ignored_accession_ids_file )
+
+    metrics = Metrics()
+    metrics.start(args.metrics_json, args.metrics_prom, args.metrics_interval)
+    profiler = None
+    if args.profile:
+        profiler = Profiler(args.profile_dir, args.profile_cprofile,
+            trace_memory=args.profile_memory, top_n=args.profile_top_n)
+        metrics.profiler = profiler
+        profiler.start()
+
+    downloader = ENCODEDownloader(
+        work_dir=args.dir,
+        file_types=args.file_types,
+        assemblies=args.assemblies,
+        encode_access_key_id=args.encode_access_key_id,
+        encode_secret_key=args.encode_secret_key,
+        pooled_rep_only=args.pooled_rep_only,
+        dry_run=args.dry_run,
+        max_download=args.max_download,
+        ignore_released=args.ignore_released,
+        ignore_unpublished=args.ignore_unpublished,
+        filter_on_portal=args.filter_on_portal,
+        base_url=args.encode_base_url,
+        metrics=metrics,
+        shard=args.shard,
+        shard_by=args.shard_by,
+        on_complete=get_completion_event_handler(args),
+        verify_md5_on_complete=args.verify_md5_on_complete,
+        compact_metadata=args.compact_metadata,
+        metadata_cache_dir=args.metadata_cache_dir)
+    try:
+        download(args, downloader, ignored_accession_ids)
+    finally:
+        if downloader.on_complete:
+            downloader.on_complete.close()
+        metrics.stop()
+        print(metrics.get_phase_summary())
+        if profiler:
+            profiler.stop()
+            print('Profile report: {}'.format(profiler.write_report(metrics)))
+
+def get_completion_event_handler(args):
+    if not args.on_complete_cmd and not args.completion_events_file:
+        return None
+    return CompletionEventHandler(args.completion_events_file, args.on_complete_cmd)
+
+class CompletionEventHandler(object):
+    '''
+    on_complete of ENCODEDownloader, called in download threads: appends an event
+    as a JSON line to events_file and/or runs a shell command with the event.
+    A FIFO is opened without blocking. While it has no reader, events are kept
+    and written once a reader opens it. Call close() at the end of a run.
+    '''
+    def __init__(self, events_file=None, cmd=None):
+        self.events_file = events_file
+        self.cmd = cmd
+        self.lock = threading.Lock()
+        self.fifo_fd = None
+        self.fifo_buffer = [] # lines (bytes) not written to the FIFO yet
+
+    def __call__(self, event):
+        print('Experiment {} ({}): {}'.format(event['status'], event['num_files'], event['accession_id']))
+        if self.events_file:
+            self.write(json.dumps(event, sort_keys=True)+'\n')
+        if self.cmd:
+            env = dict(os.environ,
+                ENCODE_EVENT_STATUS=event['status'],
+                ENCODE_ACCESSION_ID=event['accession_id'],
+                ENCODE_EXP_DIR=event['dir'],
+                ENCODE_EVENT=json.dumps(event, sort_keys=True))
+            if subprocess.call(self.cmd, shell=True, env=env):
+                print('Failed: --on-complete-cmd for {}'.format(event['accession_id']))
+
+    def is_fifo(self):
+        try:
+            return stat.S_ISFIFO(os.stat(self.events_file).st_mode)
+        except OSError:
+            return False
+
+    def write(self, line):
+        if not self.is_fifo():
+            # one write per line so that lines from multiple downloaders do not interleave
+            with open(self.events_file, 'a') as fp:
+                fp.write(line)
+            return
+        with self.lock:
+            self.fifo_buffer.append(line.encode('utf-8'))
+            self.flush_fifo()
+
+    def flush_fifo(self):
+        # with self.lock held. never blocks: returns with lines left if there is no reader or the pipe is full
+        while self.fifo_buffer:
+            if self.fifo_fd is None:
+                try:
+                    self.fifo_fd = os.open(self.events_file, os.O_WRONLY|os.O_NONBLOCK)
+                except OSError as e:
+                    if e.errno==errno.ENXIO: return # no reader
+                    raise
+            try:
+                n = os.write(self.fifo_fd, self.fifo_buffer[0])
+            except OSError as e:
+                if e.errno==errno.EAGAIN: return # pipe is full
+                if e.errno!=errno.EPIPE: raise
+                # reader has gone: reopen for the next reader
+                os.close(self.fifo_fd)
+                self.fifo_fd = None
+                continue
+            # lines longer than PIPE_BUF can be written partially
+            self.fifo_buffer[0] = self.fifo_buffer[0][n:]
+            if not self.fifo_buffer[0]:
+                self.fifo_buffer.pop(0)
+
+    def close(self):
+        with self.lock:
+            t0 = time.time()
+            while self.fifo_buffer and time.time()-t0<FIFO_READER_TIMEOUT:
+                self.flush_fifo()
+                if self.fifo_buffer: time.sleep(0.2)
+            if self.fifo_buffer:
+                print('{} completion events were not written to {} (no reader).'.format(
+                    len(self.fifo_buffer), self.events_file))
+            if self.fifo_fd is not None:
+                os.close(self.fifo_fd)
+                self.fifo_fd = None
+
+def download(args, downloader, ignored_accession_ids):
+    with downloader:
+        accession_ids, counts = downloader.resolve_inputs(args.url_or_file, ignored_accession_ids)
+        for url_or_file, num_accession_ids, num_new, num_ignored in counts:
+            print('{}: {} accession ids, {} new, {} ignored (--ignored-accession-ids-file)'.format(
+                url_or_file, num_accession_ids, num_new, num_ignored))
+        print(accession_ids)
+
+        if not args.dry_run:
+            mkdir_p(args.dir)
+        file_order = None
+        if args.shard and not args.dry_run_list_accession_ids:
+            if args.shard_by=='file':
+                file_order = downloader.plan_file_shards(accession_ids)
+            print('Shard {}/{} (--shard-by {})'.format(args.shard[0]+1, args.shard[1], args.shard_by))
+        # ordered dict to write metadata table (including all accessions)
+        all_file_metadata = collections.OrderedDict()
+        # accession_id: [file_acc_id] submitted by this shard (--shard-by file)
+        shard_files = collections.OrderedDict()
+        # download files for each accession id
+        for accession_id in accession_ids:
+            if not downloader.in_shard_experiment(accession_id): continue
+            print("="*10+" "+accession_id+" "+"="*10)
+            if args.dry_run_list_accession_ids: continue
+            metadata, _ = downloader.download_experiment(accession_id)
+            if not args.dry_run and metadata is not None:
+                all_file_metadata[accession_id] = metadata['files']
+                if downloader.file_plan is not None:
+                    shard_files[accession_id] = [f['file_accession_id']
+                        for f in downloader.file_plan[accession_id]]
 
+    if args.dry_run and not args.dry_run_list_accession_ids:
+        print(downloader.get_plan_summary())
+    if args.shard and not args.dry_run and not args.dry_run_list_accession_ids:
+        # merged into all_files.tsv later by merge_shards.py
+        manifest = dict(shard=args.shard[0]+1, num_shards=args.shard[1], shard_by=args.shard_by,
+            accession_ids=accession_ids, file_order=file_order, plan_digest=downloader.plan_digest,
+            shard_files=shard_files, files=all_file_metadata)
+        write_file_atomic(get_shard_manifest_file(args.dir, args.shard),
+            json.dumps(manifest, indent=4))
     # make TSV for all downloaded files
-    if not args.dry_run and all_file_metadata:
-        # count max. number of files per exp. accession
-        max_num_files = max( [len(all_file_metadata[acc_id]) for acc_id in all_file_metadata] )
-        # table header
-        header = 'accession\t'+\
-            'description(comma-delimited; file_acc_id:status:file_type:file_format:output_type:bio_rep_id:pair,...)\tfile'+ \
-            '\tfile'.join([str(i+1) for i in range(max_num_files)]) + '\n'
-        contents = ''
-        # table contents        
-        for accession_id in all_file_metadata:
-            file_metadata = all_file_metadata[accession_id]
-            desc = ''
-            tmp_cnt = 0
-            for file_acc_id in file_metadata:
-                tmp_cnt += 1
-                metadata = file_metadata[file_acc_id]
-                desc += ':'.join(   [file_acc_id,
-                                    metadata['status'],
-                                    metadata['file_type'],
-                                    metadata['file_format'],
-                                    metadata['output_type'],
-                                    metadata['file_type'],
-                                    '_'.join(str(x) for x in metadata['bio_rep_id']),
-                                    str(metadata['pair']) ])
-                if tmp_cnt<len(file_metadata):
-                    desc += ','
-            files = '\t'.join( [file_metadata[a]['rel_file'] for a in file_metadata] )
-            contents += '\t'.join([accession_id,desc,files]) + '\n'
-        with open(args.dir+'/all_files.tsv',mode='w') as fp:
-            fp.write(header)
-            fp.write(contents)
+    elif not args.dry_run and all_file_metadata:
+        with downloader.metrics.phase('write_tsv'):
+            write_all_files_tsv(args.dir+'/all_files.tsv', all_file_metadata)
 
 if __name__=='__main__':
     main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+'''
+Storage of the original experiment JSON (metadata.org.json) written by
+encode_downloader.py. It is stored either as indented JSON or compact
+(gzipped, metadata.org.json.gz), with a small index (metadata.index.json)
+of the fields read by generate_pipeline_run_sh.py and a digest of the document.
+'''
+
+import os
+import json
+import gzip
+import hashlib
+from encode_utils import write_file_atomic
+
+METADATA_ORG_JSON = 'metadata.org.json'
+METADATA_ORG_JSON_GZ = 'metadata.org.json.gz'
+METADATA_INDEX_JSON = 'metadata.index.json'
+INDEX_VERSION = 2
+
+def get_index(json_data_exp, digest=None):
+    # fields read by downstream scripts
+    run_type = None
+    for f in json_data_exp.get('files', []):
+        if type(f)==dict and 'run_type' in f:
+            run_type = f['run_type']
+            break
+    return dict(
+        version=INDEX_VERSION,
+        digest=digest, # md5 of metadata.org.json (uncompressed contents of metadata.org.json.gz)
+        accession=json_data_exp.get('accession'),
+        assembly=json_data_exp.get('assembly', []),
+        run_type=run_type,
+        contributing_files=json_data_exp.get('contributing_files', []))
+
+def read_index(exp_dir):
+    # None if missing, unreadable or written by an older version
+    try:
+        with open(os.path.join(exp_dir, METADATA_INDEX_JSON), 'r') as fp:
+            index = json.load(fp)
+    except (IOError, OSError, ValueError):
+        return None
+    return index if index.get('version')==INDEX_VERSION else None
+
+def remove_if_exists(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def write_metadata_org(exp_dir, json_data_exp, compact=False):
+    '''
+    Writes metadata.org.json, or metadata.org.json.gz if compact, and metadata.index.json.
+    The document is written only if its digest differs from the one in the index,
+    so that reruns do not rewrite (or decompress) it. A file in the other format
+    is removed so that readers never see stale metadata.
+    '''
+    if compact:
+        org_file, other_file = METADATA_ORG_JSON_GZ, METADATA_ORG_JSON
+        contents = json.dumps(json_data_exp, separators=(',',':'))
+    else:
+        org_file, other_file = METADATA_ORG_JSON, METADATA_ORG_JSON_GZ
+        contents = json.dumps(json_data_exp, indent=4)
+    index = get_index(json_data_exp, hashlib.md5(contents.encode('utf-8')).hexdigest())
+    old_index = read_index(exp_dir)
+    if old_index is None or old_index['digest']!=index['digest'] or \
+        not os.path.isfile(os.path.join(exp_dir, org_file)):
+        write_file_atomic(os.path.join(exp_dir, org_file), contents, compress=compact)
+    # index last: readers trust the index only if the document exists
+    if index!=old_index:
+        write_file_atomic(os.path.join(exp_dir, METADATA_INDEX_JSON), json.dumps(index))
+    remove_if_exists(os.path.join(exp_dir, other_file))
+
+def exists(exp_dir):
+    return os.path.isfile(os.path.join(exp_dir, METADATA_ORG_JSON)) or \
+        os.path.isfile(os.path.join(exp_dir, METADATA_ORG_JSON_GZ))
+
+class MetadataOrg(object):
+    '''
+    Lazily loaded original experiment JSON in an experiment directory.
+    get() reads indexed fields from metadata.index.json if it exists,
+    and the full document is opened only by load() or for a missing index.
+
+        metadata = MetadataOrg('[WORK_DIR]/ENCSR000ELE')
+        metadata.get('assembly')
+    '''
+    def __init__(self, exp_dir):
+        self.exp_dir = exp_dir
+        self.json_data = None
+        self.index = read_index(exp_dir) if exists(exp_dir) else None
+
+    def get(self, key):
+        if self.index is None:
+            self.index = get_index(self.load())
+        return self.index[key]
+
+    def load(self):
+        if self.json_data is None:
+            gz_file = os.path.join(self.exp_dir, METADATA_ORG_JSON_GZ)
+            if os.path.isfile(gz_file):
+                with gzip.open(gz_file, 'rt') as fp:
+                    self.json_data = json.load(fp)
+            else:
+                with open(os.path.join(self.exp_dir, METADATA_ORG_JSON), 'r') as fp:
+                    self.json_data = json.load(fp)
+        return self.json_data
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+'''
+Counters, gauges, latency histograms and per-phase timings for
+encode_downloader.py, emitted as periodic JSON lines and as a
+Prometheus textfile (for node exporter's textfile collector).
+'''
+
+import time
+import json
+import threading
+import collections
+import contextlib
+import functools
+from encode_utils import write_file_atomic
+
+LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0]
+# bytes/sec
+RATE_BUCKETS = [1e5, 1e6, 5e6, 1e7, 2.5e7, 5e7, 1e8, 2.5e8, 5e8, 1e9]
+
+def format_labels(labels):
+    # labels: sorted tuple of (key, value)
+    if not labels: return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\','\\\\').replace('"','\\"'))
+        for k, v in labels) + '}'
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0]*len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, b in enumerate(self.buckets):
+            if value<=b:
+                self.counts[i] += 1
+                break
+
+    def cumulative_counts(self):
+        result = []
+        cnt = 0
+        for c in self.counts:
+            cnt += c
+            result.append(cnt)
+        return result
+
+class Metrics(object):
+    '''
+    Thread-safe metrics registry. Nothing is written until start() is called.
+
+        metrics.inc('encode_portal_requests_total', type='file')
+        metrics.observe('encode_portal_request_seconds', 0.12, type='file')
+        with metrics.phase('write_tsv'):
+            ...
+    '''
+    def __init__(self, prefix='encode'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict(dict) # name: {labels: value}
+        self.gauges = collections.defaultdict(dict)
+        self.histograms = collections.defaultdict(dict)
+        self.phases = collections.OrderedDict() # phase: [seconds, calls]
+        self.local = threading.local()
+        self.start_time = time.time()
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.json_file = None
+        self.prom_file = None
+        # encode_profiler.Profiler, notified on phase boundaries
+        self.profiler = None
+
+    def inc(self, name, value=1, **labels):
+        labels = tuple(sorted(labels.items()))
+        with self.lock:
+            self.counters[name][labels] = self.counters[name].get(labels, 0) + value
+
+    def set(self, name, value, **labels):
+        labels = tuple(sorted(labels.items()))
+        with self.lock:
+            self.gauges[name][labels] = value
+
+    def add(self, name, value, **labels):
+        # gauge that goes up and down (e.g. queue depth)
+        labels = tuple(sorted(labels.items()))
+        with self.lock:
+            self.gauges[name][labels] = self.gauges[name].get(labels, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        labels = tuple(sorted(labels.items()))
+        with self.lock:
+            if not labels in self.histograms[name]:
+                self.histograms[name][labels] = Histogram(buckets)
+            self.histograms[name][labels].observe(value)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        '''
+        Times a named phase. Nested phases pause the outer one,
+        so each phase gets its own (exclusive) time.
+        '''
+        stack = self.local.__dict__.setdefault('stack', [])
+        now = time.time()
+        if stack:
+            self._add_phase_time(stack[-1][0], now-stack[-1][1], 0)
+        if self.profiler:
+            self.profiler.switch(stack[-1][0] if stack else None, name)
+        stack.append([name, now])
+        try:
+            yield
+        finally:
+            now = time.time()
+            _, resumed = stack.pop()
+            self._add_phase_time(name, now-resumed, 1)
+            if stack:
+                stack[-1][1] = now
+            if self.profiler:
+                self.profiler.switch(name, stack[-1][0] if stack else None)
+
+    def timed(self, name):
+        # decorator version of phase()
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.phase(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def track_memory(self, label):
+        # peak memory (e.g. JSON held for an experiment), only with --profile-memory
+        if self.profiler:
+            return self.profiler.track_memory(label)
+        return contextlib.nullcontext()
+
+    def _add_phase_time(self, name, seconds, calls):
+        with self.lock:
+            if not name in self.phases:
+                self.phases[name] = [0.0, 0]
+            self.phases[name][0] += seconds
+            self.phases[name][1] += calls
+
+    def snapshot(self):
+        with self.lock:
+            return dict(
+                time=time.time(),
+                elapsed=time.time()-self.start_time,
+                counters=dict((name+format_labels(l), v)
+                    for name in self.counters for l, v in self.counters[name].items()),
+                gauges=dict((name+format_labels(l), v)
+                    for name in self.gauges for l, v in self.gauges[name].items()),
+                histograms=dict((name+format_labels(l), dict(count=h.count, sum=h.sum,
+                    buckets=dict(zip([str(b) for b in h.buckets], h.cumulative_counts()))))
+                    for name in self.histograms for l, h in self.histograms[name].items()),
+                phases=dict((p, dict(seconds=v[0], calls=v[1])) for p, v in self.phases.items()))
+
+    def to_prometheus(self):
+        lines = []
+        with self.lock:
+            for name in sorted(self.counters):
+                lines.append('# TYPE {} counter'.format(name))
+                for l, v in sorted(self.counters[name].items()):
+                    lines.append('{}{} {}'.format(name, format_labels(l), v))
+            for name in sorted(self.gauges):
+                lines.append('# TYPE {} gauge'.format(name))
+                for l, v in sorted(self.gauges[name].items()):
+                    lines.append('{}{} {}'.format(name, format_labels(l), v))
+            for name in sorted(self.histograms):
+                lines.append('# TYPE {} histogram'.format(name))
+                for l, h in sorted(self.histograms[name].items()):
+                    for b, c in zip(h.buckets, h.cumulative_counts()):
+                        lines.append('{}_bucket{} {}'.format(name, format_labels(l+(('le', b),)), c))
+                    lines.append('{}_bucket{} {}'.format(name, format_labels(l+(('le', '+Inf'),)), h.count))
+                    lines.append('{}_sum{} {}'.format(name, format_labels(l), h.sum))
+                    lines.append('{}_count{} {}'.format(name, format_labels(l), h.count))
+            name = self.prefix+'_phase_seconds'
+            lines.append('# TYPE {} gauge'.format(name))
+            for p, v in self.phases.items():
+                lines.append('{}{} {}'.format(name, format_labels((('phase', p),)), v[0]))
+        return '\n'.join(lines)+'\n'
+
+    def start(self, json_file=None, prom_file=None, interval=60.0):
+        self.json_file = json_file
+        self.prom_file = prom_file
+        if not json_file and not prom_file:
+            return
+        def run():
+            while not self.stop_event.wait(interval):
+                self.emit()
+        self.thread = threading.Thread(target=run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+        self.emit()
+
+    def emit(self):
+        if self.json_file:
+            with open(self.json_file, 'a') as fp:
+                fp.write(json.dumps(self.snapshot(), sort_keys=True)+'\n')
+        if self.prom_file:
+            # node exporter never reads a partial file
+            write_file_atomic(self.prom_file, self.to_prometheus())
+
+    def get_phase_summary(self):
+        with self.lock:
+            total = sum(v[0] for v in self.phases.values())
+            lines = ['{:<20} {:>12} {:>8} {:>7}'.format('phase', 'seconds', 'calls', '%')]
+            for p, v in self.phases.items():
+                lines.append('{:<20} {:>12.3f} {:>8} {:>6.1f}%'.format(
+                    p, v[0], v[1], 100.0*v[0]/total if total else 0.0))
+        return '\n'.join(lines)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+'''
+Per-phase profiling for encode_downloader.py and generate_pipeline_run_sh.py.
+Attached to encode_metrics.Metrics, it switches a cProfile.Profile per
+named phase and, if asked, tracks peak memory per experiment with tracemalloc.
+tracemalloc slows down every allocation, so timings taken with it are inflated.
+'''
+
+import os
+import io
+import pstats
+import cProfile
+import threading
+import contextlib
+import tracemalloc
+
+class Profiler(object):
+    '''
+        profiler = Profiler('profile', use_cprofile=True, trace_memory=True)
+        metrics.profiler = profiler
+        profiler.start()
+        with profiler.track_memory('ENCSR000ELE'):
+            ...
+        profiler.stop()
+        profiler.write_report(metrics)
+    '''
+    def __init__(self, out_dir, use_cprofile=False, trace_memory=False, top_n=20):
+        self.out_dir = os.path.abspath(out_dir)
+        self.use_cprofile = use_cprofile
+        self.trace_memory = trace_memory
+        self.top_n = top_n
+        self.profiles = {} # phase: cProfile.Profile
+        self.memory_peaks = [] # (label, peak bytes)
+
+    def start(self):
+        if self.trace_memory:
+            tracemalloc.start()
+
+    def stop(self):
+        if self.trace_memory:
+            tracemalloc.stop()
+
+    def switch(self, old_phase, new_phase):
+        # called by Metrics.phase() on phase boundaries
+        # a thread can have only one active profiler, so profile the main thread only
+        if not self.use_cprofile or \
+            threading.current_thread() is not threading.main_thread():
+            return
+        if old_phase in self.profiles:
+            self.profiles[old_phase].disable()
+        if new_phase:
+            if not new_phase in self.profiles:
+                self.profiles[new_phase] = cProfile.Profile()
+            self.profiles[new_phase].enable()
+
+    @contextlib.contextmanager
+    def track_memory(self, label):
+        if not self.trace_memory or not tracemalloc.is_tracing():
+            yield
+            return
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        try:
+            yield
+        finally:
+            _, peak = tracemalloc.get_traced_memory()
+            self.memory_peaks.append((label, peak-base))
+
+    def write_report(self, metrics):
+        '''
+        Writes [OUT_DIR]/[PHASE].pstats for each phase and [OUT_DIR]/report.txt.
+        Returns path for the report.
+        '''
+        if not os.path.isdir(self.out_dir):
+            os.makedirs(self.out_dir)
+        report = io.StringIO()
+        report.write('== Phases (exclusive wall time)\n')
+        if self.trace_memory:
+            report.write('Memory tracing (tracemalloc) was on: timings are inflated.\n')
+        report.write(metrics.get_phase_summary()+'\n')
+
+        if self.memory_peaks:
+            peaks = sorted(self.memory_peaks, key=lambda x: x[1], reverse=True)
+            report.write('\n== Memory peak per experiment (top {} of {}, max {:.1f} MB, mean {:.1f} MB)\n'.format(
+                min(self.top_n, len(peaks)), len(peaks), peaks[0][1]/1e6,
+                sum(p for _, p in peaks)/float(len(peaks))/1e6))
+            # tracemalloc has one peak for the whole process
+            report.write('Peaks include allocations of other threads (e.g. downloads) at the same time.\n')
+            for label, peak in peaks[:self.top_n]:
+                report.write('{:<20} {:>10.2f} MB\n'.format(label, peak/1e6))
+
+        for phase in self.profiles:
+            pstats_file = os.path.join(self.out_dir, '{}.pstats'.format(phase))
+            self.profiles[phase].dump_stats(pstats_file)
+            stream = io.StringIO()
+            stats = pstats.Stats(self.profiles[phase], stream=stream)
+            stats.sort_stats('cumulative').print_stats(self.top_n)
+            report.write('\n== cProfile: {} ({})\n'.format(phase, pstats_file))
+            report.write(stream.getvalue())
+
+        report_file = os.path.join(self.out_dir, 'report.txt')
+        with open(report_file, 'w') as fp:
+            fp.write(report.getvalue())
+        return report_file
@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+'''
+Helpers shared by encode_downloader.py, merge_shards.py,
+generate_pipeline_run_sh.py and their modules.
+'''
+
+import os
+import gzip
+
+def write_file_atomic(path, contents, compress=False):
+    '''
+    Writes contents (gzipped if compress) to a temporary file and renames it to path,
+    so that readers (other nodes, node exporter, ...) never see a partially written file.
+    '''
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with (gzip.open(tmp, 'wt') if compress else open(tmp, 'w')) as fp:
+        fp.write(contents)
+    os.rename(tmp, path)
@@ -3,9 +3,17 @@
 import json
 import os
 import sys
+import time
+import stat
 import argparse
+import subprocess
 import math
+import hashlib
 import collections
+from encode_metrics import Metrics
+from encode_profiler import Profiler
+from encode_metadata import MetadataOrg, METADATA_ORG_JSON, METADATA_INDEX_JSON
+from encode_utils import write_file_atomic
 
 PIPELINE_SH_ITEM_TEMPLATE = '''#!/bin/bash
 # SN={sn}
@@ -17,6 +25,35 @@ WORKDIR={pipeline_out_root_dir}/{title}; mkdir -p $WORKDIR; cd $WORKDIR
 sleep 0.5
 '''
 
+# workload model for --pipeline-size-by-workload and --pipeline-pack-by workload (defaults of --pipeline-workload-*)
+# it assumes that CPU time grows linearly with size and number of input files (controls included),
+# that a pipeline uses threads for large inputs only and that memory grows with threads.
+# these are rough defaults, not measured; calibrate them with CPU time and max. memory of finished jobs.
+#   workload (CPU hours) = size of input files in GB * CPU_HOURS_PER_GB + number of input files * CPU_HOURS_PER_FILE
+#   nth = size in GB / GB_PER_THREAD (at least 1)
+#   mem (GB) = (MEM_GB_BASE + MEM_GB_PER_THREAD * nth) * MARGIN
+#   walltime (hours) = (WALLTIME_BASE + workload / nth) * MARGIN
+WORKLOAD_CPU_HOURS_PER_GB = 1.0
+WORKLOAD_CPU_HOURS_PER_FILE = 0.5
+WORKLOAD_GB_PER_THREAD = 4.0
+WORKLOAD_MEM_GB_BASE = 8.0
+WORKLOAD_MEM_GB_PER_THREAD = 4.0
+WORKLOAD_WALLTIME_BASE = 2.0 # hours
+# safety margin for memory and walltime
+WORKLOAD_MARGIN = 2.0
+
+# arguments that change a sample's .sh or its line in master .sh (for --incremental)
+FINGERPRINT_ARGS = ['species', 'exp_data_root_dir', 'ctl_data_root_dir', 'exp_file_type', 'ctl_file_type',
+    'pipeline_bds_script', 'pipeline_extra_param', 'pipeline_out_root_dir', 'pipeline_cluster_engine',
+    'pipeline_cluster_engine_slurm_partition', 'pipeline_cluster_engine_sge_queue',
+    'pipeline_cluster_engine_sge_pe', 'pipeline_nth_per_sample', 'pipeline_mem_per_sample',
+    'pipeline_walltime_per_sample', 'pipeline_size_by_workload', 'pipeline_workload_cpu_hours_per_gb',
+    'pipeline_workload_cpu_hours_per_file', 'pipeline_workload_gb_per_thread', 'pipeline_workload_mem_gb_base',
+    'pipeline_workload_mem_gb_per_thread', 'pipeline_workload_walltime_base', 'pipeline_workload_margin']
+
+# phase timings (and profiling with --profile)
+metrics = Metrics()
+
 def parse_arguments():
     parser = argparse.ArgumentParser(prog='Kundaje lab pipeline BDS shell script generator',
                         description='THIS PROGRAM DOES NOT SUPPORT genome hg19 and mm9!')
@@ -64,13 +101,76 @@ def parse_arguments():
                             help='Walltime in hours per sample.')
     parser.add_argument('--pipeline-number-of-samples-per-sh', type=int, default=50,
                             help='Number of samples per .sh.')
+    parser.add_argument('--pipeline-size-by-workload', action='store_true',
+                            help='Estimate workload of each sample from size and number of its input files \
+                            and set threads, memory and walltime per sample accordingly. \
+                            --pipeline-nth/mem/walltime-per-sample become upper limits. \
+                            The model is set by --pipeline-workload-*.')
+    parser.add_argument('--pipeline-workload-cpu-hours-per-gb', type=float, default=WORKLOAD_CPU_HOURS_PER_GB,
+                            help='Workload model: CPU hours per GB of input files.')
+    parser.add_argument('--pipeline-workload-cpu-hours-per-file', type=float, default=WORKLOAD_CPU_HOURS_PER_FILE,
+                            help='Workload model: CPU hours per input file.')
+    parser.add_argument('--pipeline-workload-gb-per-thread', type=float, default=WORKLOAD_GB_PER_THREAD,
+                            help='Workload model: one thread per this many GB of input files.')
+    parser.add_argument('--pipeline-workload-mem-gb-base', type=float, default=WORKLOAD_MEM_GB_BASE,
+                            help='Workload model: memory in GB for a sample with one thread, without the margin, \
+                            minus --pipeline-workload-mem-gb-per-thread.')
+    parser.add_argument('--pipeline-workload-mem-gb-per-thread', type=float, default=WORKLOAD_MEM_GB_PER_THREAD,
+                            help='Workload model: memory in GB per thread.')
+    parser.add_argument('--pipeline-workload-walltime-base', type=float, default=WORKLOAD_WALLTIME_BASE,
+                            help='Workload model: walltime in hours added to workload/threads.')
+    parser.add_argument('--pipeline-workload-margin', type=float, default=WORKLOAD_MARGIN,
+                            help='Workload model: estimated memory and walltime are multiplied by this.')
+    parser.add_argument('--pipeline-pack-by', type=str, choices=['count','workload'], default='count',
+                            help='count: Chunk samples into .sh in order (--pipeline-number-of-samples-per-sh). \
+                            workload: Same number of .sh but balanced by total estimated workload \
+                            ([PREFIX].binXXXX.sh, largest samples first).')
+    parser.add_argument('--incremental', action='store_true',
+                            help='Regenerate .sh only for new samples and samples whose inputs \
+                            (metadata files of experiment and controls, control mapping and arguments) \
+                            changed since the last run. Master .sh ([PREFIX].[TIMESTAMP].XXXX-XXXX.sh) \
+                            will have new/changed samples only. Fingerprints of samples are stored in \
+                            [PIPELINE_OUT_ROOT_DIR]/[PREFIX].fingerprints.json on every run.')
+    parser.add_argument('--watch-events', type=str,
+                            help='Completion events file (or FIFO) written by encode_downloader.py \
+                            --completion-events-file. Waits for events and writes .sh for a sample \
+                            as soon as the latest events of its experiment and all its controls are complete. \
+                            Submit lines are appended to [PREFIX].events.sh. \
+                            Exits when all samples are written, or when there are no more events \
+                            and the rest wait on experiments that failed after the watcher started.')
+    parser.add_argument('--submit', action='store_true',
+                            help='With --watch-events, submit (or run for local) each sample immediately.')
+    parser.add_argument('--pipeline-max-local-runs', type=int, default=1,
+                            help='With --submit and --pipeline-cluster-engine local, \
+                            maximum number of samples run at the same time. Others wait in a queue.')
+    parser.add_argument('--profile', action='store_true',
+                            help='Profile time of each phase and write a report to --profile-dir.')
+    parser.add_argument('--profile-cprofile', action='store_true',
+                            help='With --profile, also run cProfile for each phase and write [PHASE].pstats.')
+    parser.add_argument('--profile-memory', action='store_true',
+                            help='With --profile, also track peak memory per sample with tracemalloc. \
+                            This slows down the run, so timings taken with it are inflated.')
+    parser.add_argument('--profile-dir', type=str, default='profile',
+                            help='Output directory for --profile.')
+    parser.add_argument('--profile-top-n', type=int, default=20,
+                            help='Number of functions/samples shown in the profile report.')
     args = parser.parse_args()
 
     if args.ctl_data_root_dir and not args.exp_id_to_ctl_id_file or \
         not args.ctl_data_root_dir and args.exp_id_to_ctl_id_file:
         raise Exception('--ctl-data-root-dir and --exp-id-to-ctl-id-file must be defined together.')
+    if args.submit and not args.watch_events:
+        raise Exception('--submit works with --watch-events only.')
+    if args.watch_events and args.incremental:
+        raise Exception('--watch-events and --incremental cannot be used together.')
+    if args.pipeline_max_local_runs<1:
+        raise Exception('--pipeline-max-local-runs must be >0.')
     if args.pipeline_nth_per_sample<1:
         raise Exception('--pipeline-nth-per-sample must be >0.')
+    if args.pipeline_workload_gb_per_thread<=0:
+        raise Exception('--pipeline-workload-gb-per-thread must be >0.')
+    if args.pipeline_workload_margin<1:
+        raise Exception('--pipeline-workload-margin must be >=1.')
     args.pipeline_out_root_dir = os.path.abspath(args.pipeline_out_root_dir)
     ctl_exists = args.ctl_data_root_dir!=None
     return args, ctl_exists
@@ -79,6 +179,7 @@ def mkdir_p(path):
     if os.path.exists(path): return
     os.makedirs(path)
 
+@metrics.timed('read_inputs')
 def read_acc_ids_file(f):
     acc_ids=[]
     with open(f,'r') as fp:
@@ -87,6 +188,7 @@ def read_acc_ids_file(f):
             acc_ids.append(line.strip())
     return acc_ids
 
+@metrics.timed('read_inputs')
 def read_exp_to_ctl_file(f):
     map_exp_to_ctl={}
     with open(f,'r') as fp:
@@ -118,36 +220,35 @@ def parse_file_acc_json(obj):
     rel_file = obj['rel_file']
     return file_type, output_type, bio_rep_id, pair, paired_with, rel_file
 
-def is_paired_end(metadata_org_json_file):
-    with open(metadata_org_json_file,'r') as fp:
-        json_obj = json.load(fp)
-    for f_obj in json_obj['files']:
-        if 'run_type' in f_obj:
-            return f_obj['run_type']=='paired-ended'
+# metadata_org: encode_metadata.MetadataOrg (indexed fields are read without the full JSON)
+@metrics.timed('read_metadata_org')
+def is_paired_end(metadata_org):
+    run_type = metadata_org.get('run_type')
+    if run_type is not None:
+        return run_type=='paired-ended'
     raise Exception('could not find endedness information from {}'.format(
-        metadata_org_json_file))
+        metadata_org.exp_dir))
 
-def infer_species(metadata_org_json_file):
-    with open(metadata_org_json_file,'r') as fp:
-        json_obj = json.load(fp)
-    assembly = json_obj['assembly']
+@metrics.timed('read_metadata_org')
+def infer_species(metadata_org):
+    assembly = metadata_org.get('assembly')
     if 'GRCh38' in assembly: return 'hg38'
     if 'hg19' in assembly: return 'hg19'
     if 'GRCm38' in assembly or 'mm10' in assembly: return 'mm10'
     if 'mm9' in assembly: return 'mm9'
+    json_obj = metadata_org.load()
     if deep_search(json_obj, 'Homo sapiens'):
         return 'hg38'
     if deep_search(json_obj, 'Mus Musculus'):
         return 'mm10'
     raise Exception('could not find/infer species from {}'.format(
-        metadata_org_json_file))
+        metadata_org.exp_dir))
 
-def get_contributing_file_acc_ids(metadata_org_json_file):
-    with open(metadata_org_json_file,'r') as fp:
-        json_obj = json.load(fp)
+@metrics.timed('read_metadata_org')
+def get_contributing_file_acc_ids(metadata_org):
     result = []
     # convert /files/[file_acc_id]/ to [file_acc_id]
-    for s in json_obj['contributing_files']:
+    for s in metadata_org.get('contributing_files'):
         result.append(s.split('/files/')[1].strip('/'))
     # print(result)
     return result
@@ -169,11 +270,18 @@ def deep_search(json, s, help_str='root',debug=False):
             pass
     return ret
 
-def parse_metadata_json_file(json_file, file_type_to_run_pipeline):
+@metrics.timed('parse_metadata')
+def parse_metadata_json_file(json_file, file_type_to_run_pipeline, file_sizes=None):
+    '''
+    If file_sizes (dict) is given, it is updated with rel_file: file_size.
+    '''
     with open(json_file,'r') as fp:
         json_obj = json.load(fp)
     result = []
     files = json_obj['files']
+    if file_sizes is not None:
+        for file_acc_id in files:
+            file_sizes[files[file_acc_id]['rel_file']] = files[file_acc_id].get('file_size')
 
     # bio_rep_id does not always start from rep1 sometimes it's like [rep3, rep5]
     # so make it start from rep1 and increment [rep3, rep5] -> [rep1, rep2]
@@ -230,7 +338,11 @@ def parse_metadata_json_file(json_file, file_type_to_run_pipeline):
     return result
 
 def parse_exp_metadata_json(exp, ctls, contributing_file_acc_ids):
+    '''
+    Returns command line parameters for input files and a list of input files.
+    '''
     input_file_param = ''
+    input_files = []
 
     print("exps:")
     for (file_acc_id, file_type, output_type, bio_rep_id, pair, merge_id,
@@ -238,6 +350,7 @@ def parse_exp_metadata_json(exp, ctls, contributing_file_acc_ids):
 
         print(file_acc_id, file_type, output_type, bio_rep_id, pair, merge_id,
             paired_with, rel_file)
+        input_files.append(rel_file)
         if file_type=='fastq':
             input_file_param += '-fastq{}_{}{} {} \\\n'.format(
                 bio_rep_id,
@@ -281,6 +394,7 @@ def parse_exp_metadata_json(exp, ctls, contributing_file_acc_ids):
                     continue
                 print(file_acc_id, file_type, output_type, bio_rep_id, pair, merge_id,
                     paired_with, rel_file)
+                input_files.append(rel_file)
 
                 if file_type=='fastq':
                     input_file_param += '-ctl_fastq{}_{}{} {} \\\n'.format(
@@ -303,127 +417,266 @@ def parse_exp_metadata_json(exp, ctls, contributing_file_acc_ids):
                     Exception('fastq and bam input only!')
             if skip_checking_file_acc_id:
                 break
-    return input_file_param.strip()
-
-def main():
-    args, ctl_exists = parse_arguments()
-
-    mkdir_p(args.pipeline_out_root_dir)
-
-    if ctl_exists:
-        map_exp_to_ctl = read_exp_to_ctl_file(args.exp_id_to_ctl_id_file)
+    return input_file_param.strip(), input_files
+
+def get_input_size(input_files, file_sizes):
+    size = 0
+    for f in input_files:
+        file_size = file_sizes.get(f)
+        # file_size is missing in metadata.json written by old versions of encode_downloader.py
+        if not file_size and os.path.exists(f):
+            file_size = os.path.getsize(f)
+        size += file_size or 0
+    return size
+
+def get_workload(args, size_gb, num_files):
+    # estimated CPU hours
+    return size_gb*args.pipeline_workload_cpu_hours_per_gb + \
+        num_files*args.pipeline_workload_cpu_hours_per_file
+
+def get_sample_resources(args, input_files, file_sizes):
+    '''
+    Returns dict(nth, mem (GB), walltime (hours), workload (CPU hours)).
+    '''
+    resources = dict(
+        nth=args.pipeline_nth_per_sample,
+        mem=args.pipeline_mem_per_sample,
+        walltime=args.pipeline_walltime_per_sample,
+        workload=None)
+    if file_sizes is None:
+        return resources
+    size_gb = get_input_size(input_files, file_sizes)/1e9
+    workload = get_workload(args, size_gb, len(input_files))
+    resources['workload'] = workload
+    if args.pipeline_size_by_workload:
+        margin = args.pipeline_workload_margin
+        nth = max(1, min(args.pipeline_nth_per_sample,
+            int(math.ceil(size_gb/args.pipeline_workload_gb_per_thread))))
+        resources['nth'] = nth
+        resources['mem'] = min(args.pipeline_mem_per_sample, int(math.ceil(margin*(
+            args.pipeline_workload_mem_gb_base+args.pipeline_workload_mem_gb_per_thread*nth))))
+        resources['walltime'] = min(args.pipeline_walltime_per_sample, int(math.ceil(margin*(
+            args.pipeline_workload_walltime_base+workload/nth))))
+    return resources
+
+@metrics.timed('render_sh')
+def get_sample_sh_item(args, exp_id, sn, map_exp_to_ctl=None):
+    exp_metadata_json_file = '{}/{}/metadata.json'.format(
+                        args.exp_data_root_dir, exp_id)
+    exp_metadata_org = MetadataOrg('{}/{}'.format(
+                        args.exp_data_root_dir, exp_id))
+    # file sizes are needed only for workload estimation
+    if args.pipeline_size_by_workload or args.pipeline_pack_by=='workload':
+        file_sizes = {}
+    else:
+        file_sizes = None
+    exp_metadata_json = parse_metadata_json_file(
+        exp_metadata_json_file,
+        args.exp_file_type, file_sizes)
 
-    sh_items = []
+    if args.species:
+        species = args.species
+    else:
+        species = infer_species(exp_metadata_org)
 
+    exp_paired_end = is_paired_end(exp_metadata_org)
+    if exp_paired_end:
+        input_end_param = '-pe '
+    else:
+        input_end_param = '-se '
+
+    ctl_metadata_jsons = []
+    if map_exp_to_ctl and exp_id in map_exp_to_ctl:
+        for ctl_id in map_exp_to_ctl[exp_id].split(','):
+            ctl_metadata_json_file = '{}/{}/metadata.json'.format(
+                                args.ctl_data_root_dir, ctl_id)
+            ctl_metadata_org = MetadataOrg('{}/{}'.format(
+                                args.ctl_data_root_dir, ctl_id))
+            ctl_metadata_json = parse_metadata_json_file(
+                ctl_metadata_json_file,
+                args.ctl_file_type if args.ctl_file_type else args.exp_file_type,
+                file_sizes)
+            ctl_paired_end = is_paired_end(ctl_metadata_org)
+            if ctl_paired_end:
+                input_end_param += '-ctl_pe '
+            else:
+                input_end_param += '-ctl_se '
+            contributing_file_acc_ids = get_contributing_file_acc_ids(exp_metadata_org)
+            ctl_metadata_jsons.append(ctl_metadata_json)
+    else:
+        contributing_file_acc_ids = []
+    
+    input_file_param, input_files = parse_exp_metadata_json(
+        exp_metadata_json, ctl_metadata_jsons, contributing_file_acc_ids)
+    resources = get_sample_resources(args, input_files, file_sizes)
+
+    sh_item = PIPELINE_SH_ITEM_TEMPLATE.format(
+        sn = sn,            
+        title = exp_id,
+        bds = 'bds_scr {}'.format(exp_id) if args.pipeline_cluster_engine=='local' else 'bds',
+        species = species,
+        input_end_param = input_end_param,
+        input_file_param = input_file_param,
+        pipeline_out_root_dir = args.pipeline_out_root_dir,
+        pipeline_bds_script = args.pipeline_bds_script,
+        pipeline_nth_per_sample = resources['nth'],
+        pipeline_extra_param = '-system local ' + args.pipeline_extra_param)
+    return sh_item, resources
+
+def get_file_digest(path):
+    try:
+        with open(path,'rb') as fp:
+            return hashlib.md5(fp.read()).hexdigest()
+    except (IOError, OSError):
+        return None
+
+def get_file_stat(path):
+    try:
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime_ns]
+    except OSError:
+        return None
+
+@metrics.timed('fingerprint')
+def get_sample_fingerprint(args, exp_id, map_exp_to_ctl=None):
+    '''
+    Fingerprint of everything a sample's .sh depends on, without parsing.
+    metadata.json and metadata.index.json are small, so their contents are hashed.
+    The index has a digest of the large metadata.org.json(.gz), which is
+    fingerprinted by size and mtime only if there is no index (old downloads).
+    SN is left out so that adding a sample does not change the following ones.
+    '''
+    data_dirs = ['{}/{}'.format(args.exp_data_root_dir, exp_id)]
+    ctl_ids = map_exp_to_ctl.get(exp_id) if map_exp_to_ctl else None
+    if ctl_ids:
+        for ctl_id in ctl_ids.split(','):
+            data_dirs.append('{}/{}'.format(args.ctl_data_root_dir, ctl_id))
+    files = []
+    for data_dir in data_dirs:
+        files.append([data_dir, get_file_digest(os.path.join(data_dir, 'metadata.json'))])
+        index = get_file_digest(os.path.join(data_dir, METADATA_INDEX_JSON))
+        if index:
+            files.append([data_dir, index])
+        else:
+            files.append([data_dir, get_file_stat(os.path.join(data_dir, METADATA_ORG_JSON))])
+    params = dict((k, getattr(args, k)) for k in FINGERPRINT_ARGS)
+    return hashlib.md5(json.dumps([ctl_ids, files, params],
+        sort_keys=True).encode('utf-8')).hexdigest()
+
+def read_fingerprints(fingerprint_file):
+    if not os.path.exists(fingerprint_file):
+        return {}
+    with open(fingerprint_file,'r') as fp:
+        return json.load(fp)
+
+def write_fingerprints(fingerprint_file, fingerprints):
+    write_file_atomic(fingerprint_file, json.dumps(fingerprints, indent=4))
+
+def iter_sh_items(args, exp_ids, map_exp_to_ctl=None, fingerprints=None, old_fingerprints=None):
+    '''
+    Yields (exp_id, sn, sh_item, resources) for each sample.
+    If fingerprints (dict) is given, it is filled with fingerprints of all samples
+    and samples with the same fingerprint in old_fingerprints are skipped.
+    '''
     sn = 0
-    exp_ids = read_acc_ids_file(args.exp_acc_ids_file)
     for exp_id in exp_ids:            
         if exp_id.startswith('#'): continue
-        print('==== {} ===='.format(exp_id))
         sn += 1
-        exp_metadata_json_file = '{}/{}/metadata.json'.format(
-                            args.exp_data_root_dir, exp_id)
-        exp_metadata_org_json_file = '{}/{}/metadata.org.json'.format(
-                            args.exp_data_root_dir, exp_id)
-        exp_metadata_json = parse_metadata_json_file(
-            exp_metadata_json_file,
-            args.exp_file_type)
-
-        if args.species:
-            species = args.species
-        else:
-            species = infer_species(exp_metadata_org_json_file)
-
-        exp_paired_end = is_paired_end(exp_metadata_org_json_file)
-        if exp_paired_end:
-            input_end_param = '-pe '
-        else:
-            input_end_param = '-se '
-
-        ctl_metadata_jsons = []
-        if ctl_exists and exp_id in map_exp_to_ctl:
-            for ctl_id in map_exp_to_ctl[exp_id].split(','):
-                ctl_metadata_json_file = '{}/{}/metadata.json'.format(
-                                    args.ctl_data_root_dir, ctl_id)
-                ctl_metadata_org_json_file = '{}/{}/metadata.org.json'.format(
-                                    args.ctl_data_root_dir, ctl_id)
-                ctl_metadata_json = parse_metadata_json_file(
-                    ctl_metadata_json_file,
-                    args.ctl_file_type if args.ctl_file_type else args.exp_file_type)
-                ctl_paired_end = is_paired_end(ctl_metadata_org_json_file)
-                if ctl_paired_end:
-                    input_end_param += '-ctl_pe '
-                else:
-                    input_end_param += '-ctl_se '
-                contributing_file_acc_ids = get_contributing_file_acc_ids(exp_metadata_org_json_file)
-                ctl_metadata_jsons.append(ctl_metadata_json)
-        else:
-            ctl_metadata_json = None
-            contributing_file_acc_ids = []
-        
-        input_file_param = parse_exp_metadata_json(
-            exp_metadata_json, ctl_metadata_jsons, contributing_file_acc_ids)
-
-        sh_item = PIPELINE_SH_ITEM_TEMPLATE.format(
-            sn = sn,            
-            title = exp_id,
-            bds = 'bds_scr {}'.format(exp_id) if args.pipeline_cluster_engine=='local' else 'bds',
-            species = species,
-            input_end_param = input_end_param,
-            input_file_param = input_file_param,
-            pipeline_out_root_dir = args.pipeline_out_root_dir,
-            pipeline_bds_script = args.pipeline_bds_script,
-            pipeline_nth_per_sample = args.pipeline_nth_per_sample,
-            pipeline_extra_param = '-system local ' + args.pipeline_extra_param)
-        sh_items.append((exp_id, sh_item))
-    
-    master_sh_prefix = os.path.join(args.pipeline_out_root_dir,
-                    args.pipeline_sh_filename_prefix)
-    for i in range(int(math.ceil(len(sh_items)/float(args.pipeline_number_of_samples_per_sh)))):
+        if fingerprints is not None:
+            fingerprints[exp_id] = get_sample_fingerprint(args, exp_id, map_exp_to_ctl)
+            if old_fingerprints and old_fingerprints.get(exp_id)==fingerprints[exp_id] \
+                and os.path.exists(get_sample_sh(args, exp_id)):
+                continue
+        print('==== {} ===='.format(exp_id))
+        # peak memory of JSON held for a sample (with --profile-memory)
+        with metrics.track_memory(exp_id):
+            sh_item, resources = get_sample_sh_item(args, exp_id, sn, map_exp_to_ctl)
+        yield exp_id, sn, sh_item, resources
+
+def get_sample_sh(args, exp_id):
+    return '{}.sh'.format(os.path.join(args.pipeline_out_root_dir, format(exp_id)))
+
+def write_sample_sh(args, exp_id, sh_item):
+    sample_sh = get_sample_sh(args, exp_id)
+    with open(sample_sh,'w') as fp:
+        fp.write(sh_item)
+    sample_out_dir = os.path.join(args.pipeline_out_root_dir, exp_id)
+    mkdir_p(sample_out_dir)
+    return sample_sh
+
+def get_submit_cmd(args, exp_id, sample_sh, resources):
+    o = os.path.join(args.pipeline_out_root_dir, exp_id, 'out.log')
+    e = o
+    if args.pipeline_cluster_engine=='slurm':
+        line = 'sbatch -J {} -o {} -e {} --export=ALL -n 1 --ntasks-per-node=1 --cpus-per-task={} '
+        line += '--mem {}G -t {} -p {} {}'
+        line = line.format(
+            exp_id,
+            o,
+            e,                    
+            resources['nth'],
+            int(resources['mem']), # GB
+            resources['walltime']*60, # hours
+            args.pipeline_cluster_engine_slurm_partition,
+            sample_sh)
+    elif args.pipeline_cluster_engine=='sge':
+        line = 'qsub -o {} -e {} -V -pe {} {} '
+        line += '-l h_vmem={}G,s_vmem={}G,h_rt={}:00:00,s_rt={}:00:00 -q {} {}'
+        line = line.format(
+            o,
+            e,
+            args.pipeline_cluster_engine_sge_pe,
+            resources['nth'],
+            resources['mem'],
+            resources['mem'],
+            resources['walltime'],
+            resources['walltime'],
+            args.pipeline_cluster_engine_sge_queue,
+            sample_sh)
+    else:
+        line = 'bash {}'.format(sample_sh)
+    return line
+
+def get_master_sh_item(exp_id, sn, submit_cmd):
+    return 'echo "SN={} EXP_ID={}"\n{}\nsleep 5\n\n'.format(sn, exp_id, submit_cmd)
+
+def get_master_sh_lines(args, sh_items, sns):
+    lines_in_master_sh = ''
+    # write sh for individual sample
+    for j in sns:
+        exp_id, sn, sh_item, resources = sh_items[j]
+        sample_sh = write_sample_sh(args, exp_id, sh_item)
+        line = get_submit_cmd(args, exp_id, sample_sh, resources)
+        lines_in_master_sh += get_master_sh_item(exp_id, sn, line)
+    return lines_in_master_sh
+
+def pack_by_workload(sh_items, num_bins):
+    '''
+    Assigns samples to bins, largest workload first to the least loaded bin.
+    Returns a list of (total workload, [index of sample]) for each bin.
+    '''
+    bins = [[0.0, i, []] for i in range(num_bins)]
+    order = sorted(range(len(sh_items)), key=lambda j: -sh_items[j][3]['workload'])
+    for j in order:
+        b = min(bins, key=lambda x: (x[0], x[1]))
+        b[0] += sh_items[j][3]['workload']
+        b[2].append(j)
+    return [(b[0], b[2]) for b in bins]
+
+@metrics.timed('write_sh')
+def write_master_shs(args, sh_items, master_sh_prefix):
+    num_shs = int(math.ceil(len(sh_items)/float(args.pipeline_number_of_samples_per_sh)))
+    if args.pipeline_pack_by=='workload':
+        for i, (workload, sns) in enumerate(pack_by_workload(sh_items, num_shs)):
+            master_sh = '{prefix}.bin{i:04d}.sh'.format(prefix = master_sh_prefix, i = i+1)
+            print('{}: {} samples, workload {:.1f} CPU hours'.format(master_sh, len(sns), workload))
+            with open(master_sh,'w') as fp:
+                fp.write(get_master_sh_lines(args, sh_items, sns))
+        return
+    for i in range(num_shs):
         start = i*args.pipeline_number_of_samples_per_sh
         end = min(len(sh_items), (i+1)*args.pipeline_number_of_samples_per_sh)
-        lines_in_master_sh = ''
-        # write sh for individual sample
-        for j in range(start,end):
-            exp_id, sh_item = sh_items[j]
-            sample_sh_prefix = os.path.join(args.pipeline_out_root_dir, format(exp_id))
-            sample_sh = '{}.sh'.format(sample_sh_prefix)
-            with open(sample_sh,'w') as fp:
-                fp.write(sh_item)
-            sample_out_dir = os.path.join(args.pipeline_out_root_dir, exp_id)
-            mkdir_p(sample_out_dir)
-            o = os.path.join(sample_out_dir, 'out.log')
-            e = o
-            lines_in_master_sh += 'echo "SN={} EXP_ID={}"\n'.format(j+1,exp_id)
-            if args.pipeline_cluster_engine=='slurm':
-                line = 'sbatch -J {} -o {} -e {} --export=ALL -n 1 --ntasks-per-node=1 --cpus-per-task={} '
-                line += '--mem {}G -t {} -p {} {}'
-                line = line.format(
-                    exp_id,
-                    o,
-                    e,                    
-                    args.pipeline_nth_per_sample,
-                    int(args.pipeline_mem_per_sample), # GB
-                    args.pipeline_walltime_per_sample*60, # hours
-                    args.pipeline_cluster_engine_slurm_partition,
-                    sample_sh)
-            elif args.pipeline_cluster_engine=='sge':
-                line = 'qsub -o {} -e {} -V -pe {} {} '
-                line += '-l h_vmem={}G,s_vmem={}G,h_rt={}:00:00,s_rt={}:00:00 -q {} {}'
-                line = line.format(
-                    o,
-                    e,
-                    args.pipeline_cluster_engine_sge_pe,
-                    args.pipeline_nth_per_sample,
-                    args.pipeline_mem_per_sample,
-                    args.pipeline_mem_per_sample,
-                    args.pipeline_walltime_per_sample,
-                    args.pipeline_walltime_per_sample,
-                    args.pipeline_cluster_engine_sge_queue,
-                    sample_sh)
-            else:
-                line = 'bash {}'.format(sample_sh)
-            lines_in_master_sh += '{}\nsleep 5\n\n'.format(line)
+        lines_in_master_sh = get_master_sh_lines(args, sh_items, range(start,end))
 
         # write master runner sh for group of sample .sh
         with open('{prefix}.{start:04d}-{end:04d}.sh'.format(
@@ -431,7 +684,178 @@ def main():
                     start = start+1,
                     end = end),'w') as fp:
             fp.write(lines_in_master_sh)
-            # fp.write('\n'.join(sh_items[start:end]))
+
+def iter_events(events_file, poll_interval=1.0):
+    '''
+    Yields events (dict) from a JSON lines file, following it like tail -f,
+    and None whenever there are no more events for now (end of file or all writers closed a FIFO).
+    A FIFO is reopened whenever all writers close it.
+    Waits for the file if it does not exist yet (watcher started before downloaders).
+    '''
+    while not os.path.exists(events_file):
+        time.sleep(poll_interval)
+    is_fifo = stat.S_ISFIFO(os.stat(events_file).st_mode)
+    while True:
+        with open(events_file, 'rb') as fp:
+            while True:
+                pos = fp.tell() if not is_fifo else None
+                line = fp.readline()
+                if line.endswith(b'\n'):
+                    if line.strip():
+                        yield json.loads(line.decode('utf-8'))
+                elif is_fifo:
+                    break
+                else:
+                    # wait for more (or the rest of a partially written line)
+                    fp.seek(pos)
+                    yield None
+                    time.sleep(poll_interval)
+        yield None
+
+def get_failed_deps(deps, latest, since=None):
+    # deps whose latest event is not complete (and was written after since)
+    return [d for d in deps if d in latest and latest[d]['status']!='complete' and
+        (since is None or latest[d]['time']>=since)]
+
+def start_submits(args, procs, queued):
+    '''
+    Starts queued submit commands (exp_id, line). Local pipelines run in the background,
+    at most --pipeline-max-local-runs at a time.
+    '''
+    while queued:
+        if args.pipeline_cluster_engine=='local' and \
+            sum(p.poll() is None for _, p in procs)>=args.pipeline_max_local_runs:
+            return
+        exp_id, line = queued.popleft()
+        print('Submitting: {}'.format(line))
+        procs.append((exp_id, subprocess.Popen(line, shell=True)))
+
+def watch(args, exp_ids, map_exp_to_ctl, master_sh_prefix):
+    '''
+    Writes (and submits with --submit) .sh for each sample as soon as
+    the latest events of its experiment and all its controls are complete.
+    A failed event is not final since a later run (e.g. a redownload) can complete it.
+    When there are no more events for now and every remaining sample waits on
+    an experiment that failed after the watcher started, they are skipped.
+    Returns fingerprints of samples written.
+    '''
+    start_time = time.time()
+    # accession_id: [exp_id] that wait for it
+    waiting = collections.defaultdict(list)
+    pending = collections.OrderedDict() # exp_id: (sn, [accession_id])
+    sn = 0
+    for exp_id in exp_ids:
+        if exp_id.startswith('#'): continue
+        sn += 1
+        deps = [exp_id]
+        if map_exp_to_ctl and exp_id in map_exp_to_ctl:
+            deps += map_exp_to_ctl[exp_id].split(',')
+        pending[exp_id] = (sn, deps)
+        for acc_id in deps:
+            waiting[acc_id].append(exp_id)
+
+    master_sh = '{}.events.sh'.format(master_sh_prefix)
+    fingerprints = collections.OrderedDict()
+    latest = {} # accession_id: latest event
+    reported = set() # samples reported to wait on failures
+    procs = [] # (exp_id, subprocess.Popen)
+    queued = collections.deque() # (exp_id, submit command)
+    print('Waiting for events of {} samples: {}'.format(len(pending), args.watch_events))
+    for event in iter_events(args.watch_events) if pending else []:
+        start_submits(args, procs, queued)
+        if event is None:
+            if all(get_failed_deps(pending[exp_id][1], latest, start_time) for exp_id in pending):
+                for exp_id in pending:
+                    print('Skipped sample {}: {} failed'.format(exp_id,
+                        ' '.join(get_failed_deps(pending[exp_id][1], latest, start_time))))
+                break
+            for exp_id in pending:
+                failed = get_failed_deps(pending[exp_id][1], latest)
+                if failed and not exp_id in reported:
+                    reported.add(exp_id)
+                    print('Sample {} waits for a new event: {} failed in an earlier run'.format(
+                        exp_id, ' '.join(failed)))
+            continue
+        acc_id = event['accession_id']
+        latest[acc_id] = event
+        for exp_id in waiting.get(acc_id, []):
+            if not exp_id in pending: continue
+            sn, deps = pending[exp_id]
+            if event['status']!='complete':
+                reported.add(exp_id)
+                print('Sample {} waits for a new event: {} {} {}'.format(
+                    exp_id, acc_id, event['status'], ' '.join(event.get('incomplete_files', []))))
+                continue
+            if get_failed_deps(deps, latest) or not all(d in latest for d in deps):
+                continue
+            del pending[exp_id]
+            print('==== {} ===='.format(exp_id))
+            with metrics.track_memory(exp_id):
+                sh_item, resources = get_sample_sh_item(args, exp_id, sn, map_exp_to_ctl)
+            sample_sh = write_sample_sh(args, exp_id, sh_item)
+            line = get_submit_cmd(args, exp_id, sample_sh, resources)
+            with open(master_sh, 'a') as fp:
+                fp.write(get_master_sh_item(exp_id, sn, line))
+            fingerprints[exp_id] = get_sample_fingerprint(args, exp_id, map_exp_to_ctl)
+            if args.submit:
+                queued.append((exp_id, line))
+        start_submits(args, procs, queued)
+        if not pending: break
+    while queued:
+        time.sleep(1)
+        start_submits(args, procs, queued)
+    # local pipelines run in background until they finish
+    for exp_id, p in procs:
+        if p.wait():
+            print('Failed to submit/run ({}): {}'.format(p.returncode, exp_id))
+    return fingerprints
+
+def main():
+    args, ctl_exists = parse_arguments()
+
+    if args.profile:
+        profiler = Profiler(args.profile_dir, args.profile_cprofile,
+            trace_memory=args.profile_memory, top_n=args.profile_top_n)
+        metrics.profiler = profiler
+        profiler.start()
+    try:
+        generate(args, ctl_exists)
+    finally:
+        if args.profile:
+            profiler.stop()
+            print(metrics.get_phase_summary())
+            print('Profile report: {}'.format(profiler.write_report(metrics)))
+
+def generate(args, ctl_exists):
+    mkdir_p(args.pipeline_out_root_dir)
+
+    if ctl_exists:
+        map_exp_to_ctl = read_exp_to_ctl_file(args.exp_id_to_ctl_id_file)
+    else:
+        map_exp_to_ctl = None
+
+    exp_ids = read_acc_ids_file(args.exp_acc_ids_file)
+    master_sh_prefix = os.path.join(args.pipeline_out_root_dir,
+                    args.pipeline_sh_filename_prefix)
+    fingerprint_file = '{}.fingerprints.json'.format(master_sh_prefix)
+    fingerprints = collections.OrderedDict()
+    if args.incremental:
+        old_fingerprints = read_fingerprints(fingerprint_file)
+        # do not overwrite master .sh of previous runs
+        master_sh_prefix += '.{}'.format(time.strftime('%Y%m%d-%H%M%S'))
+    else:
+        old_fingerprints = None
+    if args.watch_events:
+        fingerprints = read_fingerprints(fingerprint_file)
+        fingerprints.update(watch(args, exp_ids, map_exp_to_ctl, master_sh_prefix))
+        write_fingerprints(fingerprint_file, fingerprints)
+        return
+    sh_items = list(iter_sh_items(args, exp_ids, map_exp_to_ctl, fingerprints, old_fingerprints))
+    if args.incremental:
+        print('{} new/changed samples, {} unchanged samples'.format(
+            len(sh_items), len(fingerprints)-len(sh_items)))
+    write_master_shs(args, sh_items, master_sh_prefix)
+    write_fingerprints(fingerprint_file, fingerprints)
     
 if __name__=='__main__':
     main()
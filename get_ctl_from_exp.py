@@ -3,12 +3,15 @@
 import json
 import os
 import sys
-import subprocess
 import argparse
-import signal
 import collections
+import requests
 
-QUERY_URL_TEMPLATE = 'https://www.encodeproject.org/experiments/{}/?format=json'
+ENCODE_BASE_URL = 'https://www.encodeproject.org'
+QUERY_URL_TEMPLATE = '{}/experiments/{}/?format=json'
+
+session = requests.Session()
+session.headers.update({'accept': 'application/json'})
 
 def parse_arguments():
     parser = argparse.ArgumentParser(prog='exp_id.txt (exp_id) -> \
@@ -20,6 +23,8 @@ def parse_arguments():
                             help='exp_to_ctl.txt')
     parser.add_argument('--out-filename-ctl', type=str, default='ctl_ids.txt',
                             help='ctl_ids.txt')
+    parser.add_argument('--encode-base-url', default=ENCODE_BASE_URL, type=str,
+                            help='Base URL of the ENCODE portal.')
     args = parser.parse_args()
 
     return args
@@ -32,61 +37,22 @@ def read_acc_ids(f):
             acc_ids.append(line.strip())
     return acc_ids
 
-def get_ctl_acc_id_from_exp_acc_id(exp_acc_id):    
-    json_file = '{}.json'.format(exp_acc_id)
+def get_ctl_acc_id_from_exp_acc_id(exp_acc_id, base_url=ENCODE_BASE_URL):
     try:
-        run_shell_cmd('wget {} -O {}'.format(
-            QUERY_URL_TEMPLATE.format(exp_acc_id),
-            json_file))
-        json_obj = json.load(open(json_file,'r'))
+        # read JSON in memory instead of wget to a temporary file
+        json_obj = session.get(QUERY_URL_TEMPLATE.format(base_url, exp_acc_id)).json()
         ctl_acc_ids = []
         for possible_control in json_obj["possible_controls"]:
             ctl = possible_control["@id"]
             ctl_acc_id = ctl.split('/')[2]
             ctl_acc_ids.append(ctl_acc_id)
-        rm_f(json_file)
     except:
-        rm_f(json_file)
         return 'NO_PERMISSION'
     return ctl_acc_ids
 
-def rm_f(files):
-    if files:
-        if type(files)==list:
-            run_shell_cmd('rm -f {}'.format(' '.join(files)))
-        else:
-            run_shell_cmd('rm -f {}'.format(files))
-
-def run_shell_cmd(cmd): 
-    try:
-        p = subprocess.Popen(cmd, shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True,
-            preexec_fn=os.setsid)
-        pid = p.pid
-        pgid = os.getpgid(pid)
-        print('run_shell_cmd: PID={}, CMD={}'.format(pid, cmd))
-        ret = ''
-        while True:
-            line = p.stdout.readline()
-            if line=='' and p.poll() is not None:
-                break
-            # log.debug('PID={}: {}'.format(pid,line.strip('\n')))
-            print('PID={}: {}'.format(pid,line.strip('\n')))
-            ret += line
-        p.communicate() # wait here
-        if p.returncode > 0:
-            raise subprocess.CalledProcessError(
-                p.returncode, cmd)
-        return ret.strip('\n')
-    except:
-        # kill all child processes
-        log.exception('Unknown exception caught. '+ \
-            'Killing process group {}...'.format(pgid))
-        os.killpg(pgid, signal.SIGKILL)
-        p.terminate()
-        raise Exception('Unknown exception caught. PID={}'.format(pid))
+def iter_exp_to_ctl(exp_acc_ids, base_url=ENCODE_BASE_URL):
+    for exp_acc_id in exp_acc_ids:
+        yield exp_acc_id, get_ctl_acc_id_from_exp_acc_id(exp_acc_id, base_url)
 
 def main():
     args = parse_arguments()
@@ -94,8 +60,7 @@ def main():
 
     ctl_acc_ids = set()
     with open(args.out_filename_exp_to_ctl,'w') as fp:
-        for exp_acc_id in exp_acc_ids:
-            ctl_acc_id = get_ctl_acc_id_from_exp_acc_id(exp_acc_id)
+        for exp_acc_id, ctl_acc_id in iter_exp_to_ctl(exp_acc_ids, args.encode_base_url):
             fp.write('{}\t{}\n'.format(exp_acc_id, ','.join(ctl_acc_id)))
             ctl_acc_ids.update(ctl_acc_id)
 
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+'''
+Merges shard manifests written by encode_downloader.py --shard i/N
+into [WORK_DIR]/all_files.tsv, and rewrites each experiment's
+metadata.json so that files are in the same order as an unsharded run.
+'''
+
+import os
+import re
+import sys
+import json
+import argparse
+import collections
+from encode_downloader import write_all_files_tsv, locked
+from encode_utils import write_file_atomic
+
+SHARD_MANIFEST_PATTERN = re.compile(r'^all_files\.shard-(\d+)-of-(\d+)\.json$')
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(prog='ENCODE downloader shard merger',
+                        description='Merges outputs of encode_downloader.py --shard i/N runs.')
+    parser.add_argument('--dir', type=str, default='.',
+                            help='[WORK_DIR] shared by all shards.')
+    parser.add_argument('--allow-missing', action='store_true',
+                            help='Merge available shards even if some shards or planned files are missing.')
+    args = parser.parse_args()
+    return args
+
+def read_shard_manifests(work_dir):
+    '''
+    Returns {shard (1-based): manifest} and number of shards.
+    '''
+    manifests = {}
+    num_shards = set()
+    for filename in sorted(os.listdir(work_dir)):
+        m = SHARD_MANIFEST_PATTERN.match(filename)
+        if not m: continue
+        with open(os.path.join(work_dir, filename), 'r') as fp:
+            manifests[int(m.group(1))] = json.load(fp, object_pairs_hook=collections.OrderedDict)
+        num_shards.add(int(m.group(2)))
+    if not manifests:
+        raise Exception('No shard manifests (all_files.shard-i-of-N.json) in {}.'.format(work_dir))
+    if len(num_shards)>1:
+        raise Exception('Manifests from runs with different numbers of shards: {}.'.format(
+            sorted(num_shards)))
+    return manifests, num_shards.pop()
+
+def check_plans(manifests):
+    '''
+    Raises an exception if shards were run with different inputs or,
+    with --shard-by file, made different plans from the portal's metadata.
+    '''
+    first = manifests[min(manifests)]
+    for i in sorted(manifests):
+        m = manifests[i]
+        if m['shard_by']!=first['shard_by']:
+            raise Exception('Shards {} and {} were run with different --shard-by.'.format(min(manifests), i))
+        if m['accession_ids']!=first['accession_ids']:
+            raise Exception('Shards {} and {} have different accession ids. '
+                'Re-run all shards with the same inputs.'.format(min(manifests), i))
+        if m['shard_by']=='file' and m.get('plan_digest')!=first.get('plan_digest'):
+            raise Exception('Shards {} and {} made different plans (metadata on the portal changed '
+                'between runs?). Re-run all shards.'.format(min(manifests), i))
+
+def get_missing_files(manifests):
+    '''
+    Returns [(accession_id, file_acc_id)] planned (--shard-by file) but not submitted by any shard.
+    '''
+    manifest = manifests[min(manifests)]
+    if not manifest['file_order']:
+        return []
+    submitted = set()
+    for m in manifests.values():
+        for accession_id in m['shard_files']:
+            submitted.update(m['shard_files'][accession_id])
+    return [(accession_id, file_acc_id) for accession_id in manifest['file_order']
+        for file_acc_id in manifest['file_order'][accession_id] if not file_acc_id in submitted]
+
+def merge(manifests):
+    '''
+    Returns {accession_id: {file_acc_id: record}} ordered as an unsharded run
+    (accession IDs in input order, files in the order of the experiment's metadata).
+    '''
+    manifest = manifests[min(manifests)]
+    files = {}
+    for m in manifests.values():
+        for accession_id in m['files']:
+            files.setdefault(accession_id, {}).update(m['files'][accession_id])
+
+    all_file_metadata = collections.OrderedDict()
+    for accession_id in manifest['accession_ids']:
+        if not accession_id in files: continue
+        if manifest['file_order']:
+            file_order = manifest['file_order'][accession_id]
+        else:
+            file_order = list(files[accession_id])
+        all_file_metadata[accession_id] = collections.OrderedDict(
+            (file_acc_id, files[accession_id][file_acc_id])
+            for file_acc_id in file_order if file_acc_id in files[accession_id])
+    return all_file_metadata
+
+def reorder_metadata_json(work_dir, accession_id, file_order):
+    # files of an experiment were appended by several shards in completion order
+    exp_dir = os.path.join(work_dir, accession_id)
+    metadata_json = os.path.join(exp_dir, 'metadata.json')
+    with locked(os.path.join(exp_dir, '.metadata.lock')):
+        with open(metadata_json, 'r') as fp:
+            metadata = json.load(fp, object_pairs_hook=collections.OrderedDict)
+        files = metadata['files']
+        metadata['files'] = collections.OrderedDict(
+            [(f, files[f]) for f in file_order if f in files] +
+            [(f, files[f]) for f in files if not f in file_order])
+        write_file_atomic(metadata_json, json.dumps(metadata, indent=4))
+
+def main():
+    args = parse_arguments()
+    manifests, num_shards = read_shard_manifests(args.dir)
+
+    missing = [i for i in range(1, num_shards+1) if not i in manifests]
+    if missing:
+        msg = 'Missing shards (out of {}): {}'.format(num_shards, ', '.join(str(i) for i in missing))
+        if not args.allow_missing:
+            print(msg+'. Re-run them or use --allow-missing.')
+            sys.exit(1)
+        print(msg)
+
+    check_plans(manifests)
+    missing_files = get_missing_files(manifests)
+    if missing_files:
+        print('{} planned files were not downloaded by any shard: {}'.format(len(missing_files),
+            ', '.join('{}/{}'.format(a, f) for a, f in missing_files)))
+        if not args.allow_missing:
+            print('Re-run shards or use --allow-missing.')
+            sys.exit(1)
+
+    all_file_metadata = merge(manifests)
+    shard_by = manifests[min(manifests)]['shard_by']
+    print('Merged {} shards (--shard-by {}): {} accession ids, {} files'.format(
+        len(manifests), shard_by, len(all_file_metadata),
+        sum(len(v) for v in all_file_metadata.values())))
+
+    if shard_by=='file':
+        for accession_id in all_file_metadata:
+            reorder_metadata_json(args.dir, accession_id, list(all_file_metadata[accession_id]))
+    if all_file_metadata:
+        write_all_files_tsv(os.path.join(args.dir, 'all_files.tsv'), all_file_metadata)
+
+if __name__=='__main__':
+    main()
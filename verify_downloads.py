@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+'''
+Verifies files downloaded by encode_downloader.py (size and md5)
+against the ENCODE portal metadata.
+'''
+
+import os
+import re
+import json
+import argparse
+import collections
+import concurrent.futures
+import multiprocessing
+from encode_downloader import ENCODEDownloader, ENCODE_BASE_URL, get_file_size, md5sum_file
+import encode_metadata
+
+FILE_ACC_ID_PATTERN = re.compile(r'^(ENCFF[0-9A-Z]+)\.')
+# files with these statuses will be downloaded again
+REDOWNLOAD_STATUSES = ['missing', 'partial', 'size_mismatch', 'md5_mismatch']
+# files with these statuses cannot be resumed, so they are moved aside (or removed)
+# before downloading again: a same-size file would be skipped as existing
+CORRUPTED_STATUSES = ['size_mismatch', 'md5_mismatch']
+CORRUPTED_SUFFIX = '.corrupted'
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(prog='ENCODE download verifier',
+                        description='Compares size and md5 of all files under [WORK_DIR] \
+                        with metadata from the ENCODE portal. Writes a report and a list of \
+                        accession IDs to be downloaded again. The list can be used as an input \
+                        for encode_downloader.py, which resumes partially written files.')
+    parser.add_argument('--dir', default='.', type=str,
+                            help='[WORK_DIR] : Root directory for all downloaded genome data.')
+    parser.add_argument('--all-files-tsv', type=str,
+                            help='Verify experiments in all_files.tsv only. \
+                            If not defined, all experiments under [WORK_DIR] are verified.')
+    parser.add_argument('--nth', type=int, default=multiprocessing.cpu_count(),
+                            help='Number of processes for md5 hashing.')
+    parser.add_argument('--skip-md5', action='store_true',
+                            help='Compare file sizes only.')
+    parser.add_argument('--remove-corrupted', action='store_true',
+                            help='Remove files with wrong md5 or larger than expected. \
+                            By default they are renamed to [FILE].corrupted. \
+                            Partially written files are kept to be resumed.')
+    parser.add_argument('--offline', action='store_true',
+                            help='Do not look up the portal for files without md5/size in local metadata.')
+    parser.add_argument('--out-report', type=str,
+                            help='Report TSV ([WORK_DIR]/verify_report.tsv by default).')
+    parser.add_argument('--out-redownload-acc-ids', type=str,
+                            help='Accession IDs to be downloaded again \
+                            ([WORK_DIR]/redownload_acc_ids.txt by default).')
+    parser.add_argument('--encode-base-url', default=ENCODE_BASE_URL, type=str,
+                            help='Base URL of the ENCODE portal.')
+    parser.add_argument('--encode-access-key-id', type=str,
+                            help='ENCODE access key ID to look up unpublished files.')
+    parser.add_argument('--encode-secret-key', type=str,
+                            help='ENCODE secret key (--encode-access-key-id must be specified).' )
+    args = parser.parse_args()
+
+    if args.encode_access_key_id and not args.encode_secret_key or \
+        not args.encode_access_key_id and args.encode_secret_key:
+        print("Both parameters --encode-access-key-id and --encode-secret-key must be specified together.")
+        raise ValueError
+    if args.nth<1:
+        raise Exception('--nth must be >0.')
+    args.dir = os.path.abspath(args.dir)
+    if not args.out_report:
+        args.out_report = os.path.join(args.dir, 'verify_report.tsv')
+    if not args.out_redownload_acc_ids:
+        args.out_redownload_acc_ids = os.path.join(args.dir, 'redownload_acc_ids.txt')
+    return args
+
+def read_accession_ids_from_all_files_tsv(all_files_tsv):
+    accession_ids = []
+    with open(all_files_tsv,'r') as fp:
+        next(fp) # skip header
+        for line in fp:
+            if line.strip():
+                accession_ids.append(line.split('\t')[0])
+    return accession_ids
+
+def find_accession_ids(work_dir):
+    return sorted(d for d in os.listdir(work_dir)
+        if os.path.isfile(os.path.join(work_dir, d, 'metadata.json')))
+
+def verify_file(task):
+    '''
+    task: dict with accession_id, file_accession_id, file, file_size, md5sum
+    Returns task updated with size, md5sum_found and status.
+    '''
+    result = dict(task, size=get_file_size(task['file']), md5sum_found=None)
+    if result['size'] is None:
+        status = 'missing'
+    elif not task['file_size'] and not task['md5sum']:
+        status = 'unknown'
+    elif task['file_size'] and result['size']<task['file_size']:
+        status = 'partial'
+    elif task['file_size'] and result['size']>task['file_size']:
+        status = 'size_mismatch'
+    elif task['skip_md5'] or not task['md5sum']:
+        status = 'ok'
+    else:
+        result['md5sum_found'] = md5sum_file(task['file'])
+        status = 'ok' if result['md5sum_found']==task['md5sum'] else 'md5_mismatch'
+    result['status'] = status
+    return result
+
+def relocate(exp_dir, accession_id, rel_file):
+    # rel_file is [WORK_DIR]/[ACCESSION_ID]/... of the run that wrote metadata.json,
+    # and the tree may have been moved since then
+    marker = '/'+accession_id+'/'
+    i = rel_file.rfind(marker)
+    if i<0:
+        return rel_file
+    return os.path.join(exp_dir, rel_file[i+len(marker):])
+
+def iter_verify_tasks(work_dir, accession_ids, downloader=None, skip_md5=False):
+    for accession_id in accession_ids:
+        exp_dir = os.path.join(work_dir, accession_id)
+        metadata_json_file = os.path.join(exp_dir, 'metadata.json')
+        if os.path.isfile(metadata_json_file):
+            with open(metadata_json_file,'r') as fp:
+                metadata_files = json.load(fp)['files']
+        else:
+            metadata_files = {}
+        # file_acc_id: path found in the tree
+        found = collections.OrderedDict()
+        for root, dirs, names in os.walk(exp_dir):
+            for name in sorted(names):
+                match = FILE_ACC_ID_PATTERN.match(name)
+                if match and not name.endswith(CORRUPTED_SUFFIX):
+                    found.setdefault(match.group(1), os.path.join(root, name))
+        # file_acc_id: [file, file_size, md5sum]
+        files = collections.OrderedDict()
+        for file_acc_id in metadata_files:
+            m = metadata_files[file_acc_id]
+            file = found.pop(file_acc_id, None) or relocate(exp_dir, accession_id, m['rel_file'])
+            files[file_acc_id] = [file, m.get('file_size'), m.get('md5sum')]
+        # files not in metadata.json
+        for file_acc_id in found:
+            files[file_acc_id] = [found[file_acc_id], None, None]
+
+        org_files = None
+        for file_acc_id in files:
+            file, file_size, md5sum = files[file_acc_id]
+            if not md5sum:
+                if org_files is None: # read original metadata only if needed
+                    org_files = read_org_files(exp_dir)
+                if file_acc_id in org_files:
+                    f = org_files[file_acc_id]
+                elif downloader:
+                    f = downloader.get_json(downloader.base_url+'/files/'+file_acc_id+'/?format=json')
+                else:
+                    f = {}
+                file_size = f.get('file_size', file_size)
+                md5sum = f.get('md5sum')
+            yield dict(accession_id=accession_id, file_accession_id=file_acc_id,
+                file=file, file_size=file_size, md5sum=md5sum, skip_md5=skip_md5)
+
+def read_org_files(exp_dir):
+    # file_acc_id: file JSON embedded in metadata.org.json(.gz)
+    if not encode_metadata.exists(exp_dir):
+        return {}
+    json_obj = encode_metadata.MetadataOrg(exp_dir).load()
+    return dict((f['accession'], f) for f in json_obj.get('files', [])
+        if type(f)==dict and 'accession' in f)
+
+def verify(tasks, nth=1):
+    # largest files first to balance processes
+    tasks = sorted(tasks, key=lambda t: t['file_size'] or 0, reverse=True)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=nth) as executor:
+        for result in executor.map(verify_file, tasks):
+            yield result
+
+def write_report(report_file, results):
+    with open(report_file,'w') as fp:
+        fp.write('\t'.join(['accession', 'file_accession', 'status', 'size',
+            'expected_size', 'md5sum', 'expected_md5sum', 'file']) + '\n')
+        for r in results:
+            fp.write('\t'.join(str(x) if x is not None else '' for x in [
+                r['accession_id'], r['file_accession_id'], r['status'], r['size'],
+                r['file_size'], r['md5sum_found'], r['md5sum'], r['file']]) + '\n')
+
+def main():
+    args = parse_arguments()
+
+    if args.all_files_tsv:
+        accession_ids = read_accession_ids_from_all_files_tsv(args.all_files_tsv)
+    else:
+        accession_ids = find_accession_ids(args.dir)
+
+    downloader = None
+    if not args.offline:
+        downloader = ENCODEDownloader(work_dir=args.dir,
+            encode_access_key_id=args.encode_access_key_id,
+            encode_secret_key=args.encode_secret_key,
+            base_url=args.encode_base_url)
+    try:
+        tasks = list(iter_verify_tasks(args.dir, accession_ids, downloader, args.skip_md5))
+    finally:
+        if downloader: downloader.close()
+    print('Verifying {} files in {} experiments...'.format(len(tasks), len(accession_ids)))
+
+    results = []
+    cnt = collections.Counter()
+    for r in verify(tasks, args.nth):
+        results.append(r)
+        cnt[r['status']] += 1
+        if r['status']!='ok':
+            print('{} ({}): {}'.format(r['status'], r['accession_id'], r['file']))
+        if r['status'] in CORRUPTED_STATUSES:
+            if args.remove_corrupted:
+                os.remove(r['file'])
+            else:
+                os.rename(r['file'], r['file']+CORRUPTED_SUFFIX)
+
+    write_report(args.out_report, results)
+    redownload_acc_ids = collections.OrderedDict()
+    for r in results:
+        if r['status'] in REDOWNLOAD_STATUSES:
+            redownload_acc_ids[r['accession_id']] = None
+    with open(args.out_redownload_acc_ids,'w') as fp:
+        for accession_id in redownload_acc_ids:
+            fp.write('{}\n'.format(accession_id))
+    print(', '.join('{}: {}'.format(status, cnt[status]) for status in sorted(cnt)))
+    print('Report: {}'.format(args.out_report))
+    print('Accession IDs to be downloaded again: {}'.format(args.out_redownload_acc_ids))
+
+if __name__=='__main__':
+    main()